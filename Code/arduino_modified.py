@@ -1,8 +1,12 @@
 #!/usr/bin/env python
+import collections
 import logging
 import itertools
 import platform
+import Queue
 import serial
+import struct
+import threading
 import time
 from serial.tools import list_ports
 if platform.system() == 'Windows':
@@ -51,35 +55,199 @@ def build_cmd_str(cmd, args=None):
     return "@{cmd}%{args}$!".format(cmd=cmd, args=args)
 
 
+# Every binary frame pushed by the board starts with this byte, which never
+# shows up in the plain-text responses to commands.
+FRAME_SYNC = '\xa5'
+
+
+def frame_checksum(kind, payload):
+    """
+    The XOR of every byte in a frame after the sync byte.
+    """
+    checksum = ord(kind) ^ len(payload)
+    for byte in payload:
+        checksum ^= ord(byte)
+    return checksum
+
+
+def build_frame(kind, payload):
+    """
+    Build a binary frame, as pushed by the board.
+
+    Input:
+        kind (str): a single character saying what the frame contains
+            (for example, 'E' for encoder counts)
+        payload (str): up to 255 bytes of data
+
+    A frame is laid out as:
+
+        sync (0xA5) | kind | payload length | payload | checksum
+    """
+    return (FRAME_SYNC + kind + chr(len(payload)) + payload +
+        chr(frame_checksum(kind, payload)))
+
+
+# How the board should read each subscribed pin (see `Arduino.subscribe`).
+SUBSCRIBE_MODES = {'analog': 0, 'digital': 1, 'pulse': 2}
+SUBSCRIBE_MODE_NAMES = dict((number, name) for (name, number) in SUBSCRIBE_MODES.items())
+
+
+class StreamDemux(object):
+    """
+    Wraps a serial connection to a board that pushes binary frames (see
+    `build_frame`) in between its normal text responses.
+
+    A background thread reads everything the board sends. Frames are
+    handed to the functions registered with `on_frame` for their kind,
+    and text is split into lines which `readline` returns, so the rest of
+    the `Arduino` class works exactly the same as without streaming.
+    """
+    def __init__(self, sr):
+        self.sr = sr
+        self.timeout = getattr(sr, 'timeout', None) or 2
+        self.lines = Queue.Queue()
+        self.handlers = {}
+        self.frames = 0
+        self.bad_frames = 0
+        self._buffer = ''
+        self._text = ''
+        self._running = True
+        self._thread = threading.Thread(target=self._read_loop, name='serial-reader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_frame(self, kind, handler):
+        """
+        Calls `handler(payload)` (from the reader thread) for every frame
+        of the given kind.
+        """
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def _read_loop(self):
+        while self._running and self.sr.isOpen():
+            try:
+                data = self.sr.read(max(1, self.sr.inWaiting()))
+            except Exception, e:
+                log.debug('Reading failed: {0}'.format(e))
+                time.sleep(0.1)
+                continue
+            if data:
+                self.feed(data)
+
+    def feed(self, data):
+        """
+        Splits incoming bytes into frames and lines of text.
+        """
+        self._buffer += data
+        while self._buffer:
+            if self._buffer[0] == FRAME_SYNC:
+                if len(self._buffer) < 3:
+                    return
+                kind = self._buffer[1]
+                end = 3 + ord(self._buffer[2]) + 1
+                if len(self._buffer) < end:
+                    return
+                payload = self._buffer[3:end - 1]
+                checksum = ord(self._buffer[end - 1])
+                self._buffer = self._buffer[end:]
+                if checksum != frame_checksum(kind, payload):
+                    self.bad_frames += 1
+                    continue
+                self.frames += 1
+                for handler in self.handlers.get(kind, []):
+                    handler(payload)
+            else:
+                index = self._buffer.find(FRAME_SYNC)
+                if index == -1:
+                    index = len(self._buffer)
+                self._text += self._buffer[:index]
+                self._buffer = self._buffer[index:]
+                while '\n' in self._text:
+                    line, self._text = self._text.split('\n', 1)
+                    self.lines.put(line + '\n')
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=self.timeout)
+        except Queue.Empty:
+            return ''
+
+    def inWaiting(self):
+        return sum(len(line) for line in list(self.lines.queue))
+
+    def write(self, data):
+        return self.sr.write(data)
+
+    def flush(self):
+        self.sr.flush()
+
+    def isOpen(self):
+        return self.sr.isOpen()
+
+    def close(self):
+        self._running = False
+        if threading.current_thread() is not self._thread:
+            self._thread.join(self.timeout)
+        self.sr.close()
+
+
+def probe_port(port, baud, timeout):
+    """
+    Opens `port` and checks whether there's an arduino with a compatible
+    sketch on the other end. Returns the open serial connection, or None.
+    """
+    log.debug('Found {0}, testing...'.format(port))
+    try:
+        sr = serial.Serial(port, baud, timeout=timeout)
+    except serial.serialutil.SerialException, e:
+        log.debug(str(e))
+        return None
+    # Opening the port resets the arduino, so give it time to boot.
+    time.sleep(2)
+    version = get_version(sr)
+    if version != 'version':
+        log.debug('Bad version {0}. This is not a Shrimp/Arduino!'.format(
+            version))
+        sr.close()
+        return None
+    return sr
+
+
 def find_port(baud, timeout):
     """
     Find the first port that is connected to an arduino with a compatible
     sketch installed.
+
+    Every port is tested at the same time, since each one takes a couple
+    of seconds to answer.
     """
     if platform.system() == 'Windows':
-        ports = enumerate_serial_ports()
+        ports = list(enumerate_serial_ports())
     elif platform.system() == 'Darwin':
         ports = [i[0] for i in list_ports.comports()]
     else:
         ports = glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
+
+    results = {}
+    def probe(port):
+        results[port] = probe_port(port, baud, timeout)
+    threads = [threading.Thread(target=probe, args=(p,)) for p in ports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    found = None
     for p in ports:
-        log.debug('Found {0}, testing...'.format(p))
-        try:
-            sr = serial.Serial(p, baud, timeout=timeout)
-        except serial.serialutil.SerialException, e:
-            log.debug(str(e))
+        sr = results.get(p)
+        if sr is None:
             continue
-        time.sleep(2)
-        version = get_version(sr)
-        if version != 'version':
-            log.debug('Bad version {0}. This is not a Shrimp/Arduino!'.format(
-                version))
+        if found is None:
+            log.info('Using port {0}.'.format(p))
+            found = sr
+        else:
             sr.close()
-            continue
-        log.info('Using port {0}.'.format(p))
-        if sr:
-            return sr
-    return None
+    return found
 
 
 def get_version(sr):
@@ -110,10 +278,157 @@ class Arduino(object):
         self.sr = sr
         self.SoftwareSerial = SoftwareSerial(self)
         self.Servos = Servos(self)
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        self.sample_frames = 0
+        self.sample_clock = None
 
     def version(self):
         return get_version(self.sr)
 
+    def demux(self):
+        """
+        Starts reading from the board in the background (see
+        `StreamDemux`), so that it can push binary frames to us.
+        """
+        if not isinstance(self.sr, StreamDemux):
+            self.sr = StreamDemux(self.sr)
+            self.SoftwareSerial.sr = self.sr
+            self.Servos.sr = self.sr
+        return self.sr
+
+    def onFrame(self, kind, handler):
+        """
+        Calls `handler(payload)` for every frame of the given kind pushed
+        by the board.
+        """
+        self.demux().on_frame(kind, handler)
+
+    def subscribe(self, pins, interval, mode='analog', buffer_size=64):
+        """
+        Asks the board to read `pins` every `interval` milliseconds and
+        push the readings, instead of us asking for each one.
+
+        inputs:
+           pins: the pins to read
+           interval: how often to read them, in milliseconds
+           mode: 'analog' (like analogRead), 'digital' (like
+                 digitalRead) or 'pulse' (like pulseIn_set(pin, "HIGH"),
+                 for ultrasonic rangefinders)
+           buffer_size: how many readings to keep for each pin
+
+        The readings are pushed as 'S' frames: the board's clock in
+        milliseconds (an unsigned 32-bit int), followed by the mode, pin
+        and value of each reading (an unsigned byte, an unsigned byte and
+        an unsigned 16-bit int), all little-endian. They're kept in a ring
+        buffer per pin; see `samples` and `latest`.
+
+        Needs a sketch that understands the `sub` command.
+        """
+        demux = self.demux()
+        with self.buffers_lock:
+            if not self.buffers:
+                demux.on_frame('S', self._handle_samples)
+            for pin in pins:
+                self.buffers[(mode, pin)] = collections.deque(maxlen=buffer_size)
+        cmd_str = build_cmd_str(
+            "sub", [interval, SUBSCRIBE_MODES[mode]] + list(pins))
+        try:
+            self.sr.write(cmd_str)
+            self.sr.flush()
+        except:
+            pass
+
+    def unsubscribe(self, pins, mode='analog'):
+        """
+        Stops the board from pushing readings for `pins`.
+        """
+        cmd_str = build_cmd_str("usub", [SUBSCRIBE_MODES[mode]] + list(pins))
+        try:
+            self.sr.write(cmd_str)
+            self.sr.flush()
+        except:
+            pass
+        with self.buffers_lock:
+            for pin in pins:
+                self.buffers.pop((mode, pin), None)
+
+    def _handle_samples(self, payload):
+        if len(payload) < 4 or (len(payload) - 4) % 4 != 0:
+            return
+        (millis,) = struct.unpack('<I', payload[:4])
+        timestamp = millis / 1000.0
+        with self.buffers_lock:
+            self.sample_frames += 1
+            self.sample_clock = (timestamp, time.time())
+            for offset in range(4, len(payload), 4):
+                mode, pin, value = struct.unpack('<BBH', payload[offset:offset + 4])
+                buffer = self.buffers.get((SUBSCRIBE_MODE_NAMES.get(mode), pin))
+                if buffer is not None:
+                    buffer.append((timestamp, value))
+
+    def sampleClock(self):
+        """
+        Returns when the newest 'S' frame arrived, as (board time in 
+        seconds, our time in seconds), or None if none has arrived yet.
+        Useful for telling whether buffered readings are still fresh.
+        """
+        with self.buffers_lock:
+            return self.sample_clock
+
+    def samples(self, pin, mode='analog'):
+        """
+        Returns every buffered reading of a subscribed pin, oldest first,
+        as a list of (board time in seconds, value).
+        """
+        with self.buffers_lock:
+            return list(self.buffers.get((mode, pin), ()))
+
+    def latest(self, pin, mode='analog'):
+        """
+        Returns the newest reading of a subscribed pin as (board time in
+        seconds, value), or None if there hasn't been one yet.
+        """
+        with self.buffers_lock:
+            buffer = self.buffers.get((mode, pin))
+            if not buffer:
+                return None
+            return buffer[-1]
+
+    def streamEncoders(self, left_pin, right_pin, interval):
+        """
+        Asks the board to count the pulses from the wheel encoders on
+        `left_pin` and `right_pin`, and push the counts every `interval`
+        milliseconds as 'E' frames. The payload is the board's clock in
+        milliseconds (an unsigned 32-bit int) followed by the left and
+        right counts (signed 32-bit ints), all little-endian.
+
+        Needs a sketch that understands the `es` command.
+        """
+        self.demux()
+        cmd_str = build_cmd_str("es", (left_pin, right_pin, interval))
+        try:
+            self.sr.write(cmd_str)
+            self.sr.flush()
+        except:
+            pass
+
+    def setWatchdog(self, timeout):
+        """
+        Asks the board to stop the motors by itself if it doesn't hear
+        from us for `timeout` milliseconds (any command counts), in case
+        the program freezes or dies. A timeout of 0 turns this off.
+        Sending this again also counts as hearing from us.
+
+        Needs a sketch that understands the `wd` command.
+        """
+        cmd_str = build_cmd_str("wd", (timeout,))
+        try:
+            self.sr.write(cmd_str)
+            self.sr.flush()
+        except:
+            pass
+
     def digitalWrite(self, pin, val):
         """
         Sends digitalWrite command
@@ -41,10 +41,16 @@ because of these two reasons.
 After reading this file, move on to `sensor_analysis.py`
 '''
 
+from __future__ import division
+
+import json
 import math
+import struct
 import time
+import threading
 import sys
 import arduino_modified as Arduino
+import cameras
 import SimpleCV as scv
         
 class LedLight(object):
@@ -83,37 +89,150 @@ class LedLight(object):
         else:
             self.turn_on()
         
+class MotorProfile(object):
+    '''
+    Describes how fast a motor actually turns at different powers.
+    
+    No two motors are exactly alike. On our robot, the right motor turns 
+    about twice as fast as the left one at the same power, and most 
+    motors don't turn at all below a certain power (the "deadband"). If 
+    we sent the same power to both motors, the robot would drive in 
+    circles.
+    
+    A profile is a list of `powers` (from 0 to 1) and the `speeds` the 
+    motor was measured turning at for each of them (in any unit, as long
+    as both motors use the same one). See `robot_actions.calibrate_motors`
+    for how to measure them.
+    
+    To make both motors turn at the same speed, `match` works out which
+    power makes the motor turn at each speed from 0 to `top_speed` (the 
+    top speed of the slower motor), and stores them in a table, so turning
+    a speed into a power is just a table lookup.
+    '''
+    STEPS = 256
+    
+    def __init__(self, powers, speeds):
+        self.powers = [float(power) for power in powers]
+        self.speeds = [float(speed) for speed in speeds]
+        self.max_speed = max(self.speeds)
+        self.match(self.max_speed)
+        
+    @classmethod
+    def from_gain(cls, gain=1.0, deadband=0.0):
+        '''Makes a profile for a motor that doesn't move at or below the
+        `deadband` power, and then speeds up steadily to `gain` at full 
+        power.'''
+        return cls([0, deadband, 1], [0, 0, gain])
+        
+    def to_dict(self):
+        return {'powers': self.powers, 'speeds': self.speeds}
+        
+    def match(self, top_speed):
+        '''Builds the lookup table so that a speed of 1 makes this motor 
+        turn at `top_speed`.'''
+        self.top_speed = top_speed
+        self.table = [0] + [
+            int(round(self._power_for(top_speed * step / (MotorProfile.STEPS - 1)) * 255))
+            for step in range(1, MotorProfile.STEPS)]
+            
+    def _power_for(self, speed):
+        '''Finds the power that turns the motor at `speed` by drawing a
+        straight line between the two nearest measurements.'''
+        for i in range(1, len(self.speeds)):
+            low, high = self.speeds[i - 1], self.speeds[i]
+            if high >= speed and high > low:
+                fraction = max(0, speed - low) / (high - low)
+                return self.powers[i - 1] + fraction * (self.powers[i] - self.powers[i - 1])
+        return self.powers[-1]
+        
+    def power(self, speed):
+        '''Returns the PWM value (from 0 to 255) for a speed from 0 to 1.'''
+        return self.table[int(round(math.fabs(speed) * (MotorProfile.STEPS - 1)))]
+        
+        
+# What our robot's motors are like, until they're calibrated. The right
+# motor turns about twice as fast as the left one.
+DEFAULT_GAINS = {"left": 1.0, "right": 2.0}
+
+def default_profiles():
+    return {side: MotorProfile.from_gain(gain) for (side, gain) in DEFAULT_GAINS.items()}
+    
+def load_profiles(path):
+    '''Loads the profiles for both motors saved by `save_profiles`.'''
+    with open(path) as profiles:
+        return {side: MotorProfile(**data) for (side, data) in json.load(profiles).items()}
+        
+def save_profiles(path, profiles):
+    with open(path, 'w') as output:
+        json.dump({side: profile.to_dict() for (side, profile) in profiles.items()}, 
+            output, indent=4, sort_keys=True)
+            
+            
 class Motor(object):
     '''
     Creates a single motor, and sets the speed.
+    
+    Changing the speed of a motor all at once is hard on the drivetrain 
+    (and on the battery, since the motor draws a huge spike of current),
+    especially when going straight from full forward to full reverse. So,
+    `set_speed` only sets the speed the motor should be going at (the 
+    `target`), and the actual `speed` moves towards it by at most 
+    `max_change` a second (and by at most `max_change * MAX_STEP_TIME` 
+    each `update`, however long it's been since the last one).
+    
+    Sending a command to the Arduino also takes a while (see 
+    `simulator.py`), so the motor only sends the speed every 
+    `min_interval` seconds at most, and only if it actually changed. Any 
+    speeds set in between are merged together, and only the latest one
+    is sent. The direction pins are only written when the direction 
+    changes.
+    
+    This means `update` has to be called every tick to keep the motor 
+    moving towards its target (`Robot.update` does that for both wheels).
+    `stop` is the exception: it stops the motor straight away.
+    
+    Speeds are turned into powers using a `MotorProfile`, so that the 
+    same speed turns each motor at the same rate.
     '''
-    def __init__(self, arduino, side):
+    
+    # The pins each motor is connected to. The left motor uses motor 
+    # outputs 1 and 2, and the right motor uses motor outputs 3 and 4.
+    PINS = {
+        "left": {"PWM": 9, "dir": [11, 8]},
+        "right": {"PWM": 10, "dir": [12, 13]},
+    }
+    
+    # The longest gap between updates (in seconds) that's counted in full.
+    MAX_STEP_TIME = 0.25
+    
+    def __init__(self, arduino, side, profile=None, max_change=4.0, min_interval=0.05):
         self.arduino = arduino
+        self.profile = profile if profile is not None else MotorProfile.from_gain()
         self.speed = 0
+        self.target = 0
         self.side = side        
+        self.max_change = max_change
+        self.min_interval = min_interval
         
         assert(self.side in ["left", "right"])
-        if self.side == "left":
-            self.pins = {"PWM": 9, "dir": [11, 8]}
+        self.pins = Motor.PINS[self.side]
         
-            # PWM control for motor outputs 1 and 2
-            self.arduino.pinMode(9, "OUTPUT")
-            
-            # Directional control for motor outputs 1 and 2
-            self.arduino.pinMode(8, "OUTPUT")
-            self.arduino.pinMode(11, "OUTPUT")
-            
-        elif self.side == "right":
-            self.pins = {"PWM": 10, "dir": [12, 13]}
-            
-            # PWM control for motor outputs 3 and 4
-            self.arduino.pinMode(10, "OUTPUT")
+        # PWM control
+        self.arduino.pinMode(self.pins["PWM"], "OUTPUT")
+        
+        # Directional control
+        for pin in self.pins["dir"]:
+            self.arduino.pinMode(pin, "OUTPUT")
             
-            # Directional control for motor outputs 3 and 4
-            self.arduino.pinMode(12, "OUTPUT")
-            self.arduino.pinMode(13, "OUTPUT")
+        # What was last sent to the Arduino, and when.
+        self.sent_direction = None
+        self.sent_power = None
+        self.last_sent = 0
+        self.last_update = time.time()
         
-
+        # `stop` might be called from another thread (by a watchdog, for 
+        # example) while the main loop is in the middle of `update`.
+        self.lock = threading.RLock()
     
     def set_speed(self, speed):
         '''
@@ -125,30 +244,212 @@ class Motor(object):
         
         At the moment, positive speeds cause the wheel powered by the motor to spin towards
         the front of the robot (forward).
+        
+        The motor gets up to speed gradually; see the class docstring.
         '''
-        self.speed = speed        
+        assert(-1 <= speed <= 1)
+        with self.lock:
+            self.target = speed
+            self.update()
+            
+    def update(self, now=None):
+        '''Moves the speed towards the target, and sends it to the Arduino
+        if it's time to.'''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            # If it's been a while since the last update (a slow tick, or
+            # the first one after starting up), don't make up for lost 
+            # time all at once, or the motor would jump straight there.
+            elapsed = min(max(0, now - self.last_update), Motor.MAX_STEP_TIME)
+            step = self.max_change * elapsed
+            self.last_update = now
+            self.speed = max(self.speed - step, min(self.speed + step, self.target))
+            if now - self.last_sent >= self.min_interval:
+                self._send(now)
+                
+    def _send(self, now):
+        if self.speed > 0:
+            direction = 1
+        elif self.speed < 0:
+            direction = -1
+        else:
+            direction = 0
+        power = self.profile.power(self.speed)
+        if direction == self.sent_direction and power == self.sent_power:
+            return
+        self._write(direction, power)
+        self.last_sent = now
         
+    def _write(self, direction, power):
         PWM = self.pins["PWM"]
         dir_A = self.pins["dir"][0]
         dir_B = self.pins["dir"][1]
         
-        assert(-1 <= speed <= 1)
+        if direction != self.sent_direction:
+            if direction > 0:
+                self.arduino.digitalWrite(dir_A, "HIGH")
+                self.arduino.digitalWrite(dir_B, "LOW")
+            elif direction < 0:
+                self.arduino.digitalWrite(dir_A, "LOW")
+                self.arduino.digitalWrite(dir_B, "HIGH")
+            else:
+                self.arduino.digitalWrite(dir_A, "LOW")
+                self.arduino.digitalWrite(dir_B, "LOW")
+            self.sent_direction = direction
+        if power != self.sent_power:
+            self.arduino.analogWrite(PWM, power)
+            self.sent_power = power
+            
+    def set_power(self, power):
+        '''
+        Runs the motor forwards at `power` (from 0 to 1) straight away, 
+        ignoring the profile. This is only meant for measuring the motor
+        (see `robot_actions.calibrate_motors`).
+        '''
+        with self.lock:
+            self._write(1 if power > 0 else 0, int(round(power * 255)))
+        
+    def stop(self):
+        '''Stops the motor straight away.'''
+        with self.lock:
+            self.target = 0
+            self.speed = 0
+            self._send(time.time())
+        
+  
+class Encoders(object):
+    '''
+    Counts how far each wheel has turned, using the wheel encoders.
+    
+    Asking the Arduino for each reading would take a round trip over the 
+    serial cable every time, which is far too slow to steer with. Instead,
+    the Arduino counts the encoder pulses itself and pushes the counts to
+    us every `interval` milliseconds (see `Arduino.streamEncoders`). Each
+    time a new reading arrives, every function in `listeners` is called 
+    with (left count, right count, board time in seconds).
+    
+    Note: this needs a version of the Arduino sketch which supports 
+    streaming. With an older sketch (or a fake Arduino), the counts stay 
+    at zero.
+    '''
+    
+    # The pins the encoders are connected to, and how they relate to the 
+    # size of the robot.
+    PINS = {"left": 2, "right": 3}
+    TICKS_PER_METER = 1000
+    WHEEL_BASE = 0.4
+    
+    FORMAT = '<Iii'
+    
+    def __init__(self, arduino, interval=50):
+        self.arduino = arduino
+        self.interval = interval
+        self.counts = {"left": 0, "right": 0}
+        self.timestamp = None
+        self.readings = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+        
+        self.arduino.onFrame('E', self._handle)
+        self.arduino.streamEncoders(Encoders.PINS["left"], Encoders.PINS["right"], interval)
+        
+    def _handle(self, payload):
+        if len(payload) != struct.calcsize(Encoders.FORMAT):
+            return
+        millis, left, right = struct.unpack(Encoders.FORMAT, payload)
+        with self.lock:
+            self.counts = {"left": left, "right": right}
+            self.timestamp = millis / 1000
+            self.readings += 1
+        for listener in self.listeners:
+            listener(left, right, millis / 1000)
+            
+    def read(self):
+        '''Returns the latest (left count, right count, board time in 
+        seconds).'''
+        with self.lock:
+            return (self.counts["left"], self.counts["right"], self.timestamp)
         
 
-        if self.speed > 0:
-            self.arduino.digitalWrite(dir_A, "HIGH")
-            self.arduino.digitalWrite(dir_B, "LOW")
-        elif self.speed < 0:   
-            self.arduino.digitalWrite(dir_A, "LOW")
-            self.arduino.digitalWrite(dir_B, "HIGH")
+class Rangefinders(object):
+    '''
+    Measures how far away things are using ultrasonic rangefinders (the
+    kind with a single pin that pulses for as long as the echo took to 
+    come back).
+    
+    `Arduino.pulseIn_set` can read these, but it waits for a round trip 
+    over the serial cable for every ping, which would stall the whole 
+    program. Instead, the Arduino pings every sensor in `pins` every 
+    `interval` milliseconds and pushes the results to us (see 
+    `Arduino.subscribe`), and the last `window` pings of each sensor are
+    kept for us to read whenever we like.
+    
+    Pings older than `STALE_INTERVALS` intervals are thrown away. If a 
+    sensor has no pings left (the Arduino stopped sending them, say), it
+    is "silent": it's listed in `silent`, and `read` reports None for it
+    instead of pretending the way is clear.
+    
+    Note: this needs a version of the Arduino sketch which supports 
+    streaming. With an older sketch (or a fake Arduino), every sensor is
+    silent.
+    '''
+    
+    # How far (in meters) sound travels there and back per microsecond.
+    METERS_PER_MICROSECOND = 343.0 / 1000000 / 2
+    
+    STALE_INTERVALS = 5
+    
+    def __init__(self, arduino, pins, interval=60, window=5):
+        self.arduino = arduino
+        self.pins = list(pins)
+        self.interval = interval
+        self.window = window
+        self.silent = []
+        self.started = time.time()
+        if self.pins:
+            self.arduino.subscribe(self.pins, interval, mode='pulse', buffer_size=window)
+        
+    def read(self):
+        '''
+        Returns a dict mapping each pin to a list of the most recent 
+        distances it measured (in meters), oldest first, or to None if the
+        sensor is silent. A distance is None if nothing echoed back.
+        '''
+        max_age = Rangefinders.STALE_INTERVALS * self.interval / 1000
+        clock = self.arduino.sampleClock()
+        # The board's clock tells how old each ping is, but only if pings 
+        # are still arriving at all.
+        if clock is None or time.time() - clock[1] > max_age:
+            newest = None
+        else:
+            newest = clock[0]
+            
+        readings = {}
+        silent = []
+        for pin in self.pins:
+            distances = []
+            if newest is not None:
+                distances = [
+                    value * Rangefinders.METERS_PER_MICROSECOND if value > 0 else None
+                    for (timestamp, value) in self.arduino.samples(pin, mode='pulse')
+                    if newest - timestamp <= max_age]
+            if distances:
+                readings[pin] = distances
+            else:
+                readings[pin] = None
+                silent.append(pin)
+        # A sensor that's just been plugged in gets a moment to start up.
+        if time.time() - self.started > max_age:
+            self.silent = silent
         else:
-            self.arduino.digitalWrite(dir_A, "LOW")
-            self.arduino.digitalWrite(dir_B, "LOW")
-                        
-        self.arduino.analogWrite(PWM, math.fabs(self.speed)*255)
+            readings = dict((pin, distances) for (pin, distances) in readings.items() 
+                if distances is not None)
+        return readings
         
-    def stop(self):
-        self.set_speed(0)
+    def close(self):
+        if self.pins:
+            self.arduino.unsubscribe(self.pins, mode='pulse')
         
   
 class FakeServos(object):
@@ -208,15 +509,44 @@ class FakeArduino(object):
         
     def analogWrite(self, pin, value):
         self.pins[pin] = value
+        
+    def onFrame(self, kind, handler):
+        pass
+        
+    def streamEncoders(self, left_pin, right_pin, interval):
+        pass
+        
+    def subscribe(self, pins, interval, mode='analog', buffer_size=64):
+        pass
+        
+    def setWatchdog(self, timeout):
+        pass
+        
+    def unsubscribe(self, pins, mode='analog'):
+        pass
+        
+    def sampleClock(self):
+        return None
+        
+    def samples(self, pin, mode='analog'):
+        return []
+        
+    def latest(self, pin, mode='analog'):
+        return None
 
 class Camera(object):  
     '''  
     Represents a "camera" image. Currently grabs the image from  
     the webcam, not from the Arduino.  
+    
+    The webcam is shared with everything else that uses it through 
+    `cameras.SERVICE`. The `replay` and `record` arguments are passed to 
+    `cameras.open_camera` if nothing has opened the webcam yet.
     '''  
-    def __init__(self, arduino):  
+    def __init__(self, arduino, replay=None, record=None):  
         self.arduino = arduino  
-        self.cam = scv.Camera(0)  
+        cameras.SERVICE.open(0, replay=replay, record=record)  
+        self.cam = cameras.SERVICE.subscribe(0)  
 
     def get_image(self):  
         '''  
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+'''
+# benchmark.py #
+
+
+## About ##
+
+This module measures how fast the different parts of the robot run, so
+that we can tell whether a change made things faster or slower before
+we put it on the robots.
+
+Everything runs against recorded camera frames (see `cameras.py`) and
+the simulated serial link (see `simulator.py`), so the numbers don't
+depend on what the webcam happens to be looking at, and no robot or
+webcam is needed.
+
+It currently measures:
+
+-   `detection`: how many frames per second `get_human_locations` can
+    analyze, for every combination of `quality` and feature.
+-   `image_provider`: how many frames per second the multi-processing
+    `ImageProvider` analyzes, and how many ticks per second the main
+    loop gets while it's running, for every `quality`.
+-   `control_loop`: how many ticks per second the state machine can run
+    at, and how many bytes it sends over the serial link per command.
+-   `dashboard`: how many video frames per second each viewer of the
+    dashboard's webcam page gets, for several numbers of viewers.
+
+
+## Running ##
+
+First, record some frames:
+
+    python niftybot.py --record-frames frames/
+
+Then run:
+
+    python benchmark.py frames/ --output results.json
+
+The results are written as JSON, so that results from different
+versions can be compared with a script.
+
+The dashboard benchmark needs the [websocket-client][wc] library, and is
+skipped if it isn't installed.
+
+  [wc]: https://pypi.python.org/pypi/websocket-client
+
+
+## Dependencies ##
+
+This module uses every layer, since it measures all of them.
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import cameras
+import sensor_analysis
+import simulator
+import dashboard
+
+QUALITIES = [0.25, 0.5, 0.75, 1.0]
+FEATURES = ['face', 'profile', 'upper_body']
+VIEWERS = [1, 2, 4]
+
+
+def bench_detection(frames, qualities=QUALITIES, features=FEATURES, duration=5):
+    '''Measures `get_human_locations` directly, with no multi-processing.'''
+    camera = cameras.ReplayCamera(frames, realtime=False)
+    results = []
+    for quality in qualities:
+        for feature in features:
+            count = 0
+            found = 0
+            start = time.time()
+            while time.time() - start < duration:
+                humans = sensor_analysis.get_human_locations(camera.getImage(), quality, feature)
+                found += len(humans)
+                count += 1
+            elapsed = time.time() - start
+            results.append({
+                'quality': quality,
+                'feature': feature,
+                'frames': count,
+                'fps': count / elapsed,
+                'humans_per_frame': found / count,
+            })
+    camera.close()
+    return results
+
+
+def bench_image_provider(frames, qualities=QUALITIES, feature='face', duration=10):
+    '''Measures the multi-processing `ImageProvider` as the main loop uses it.'''
+    results = []
+    for quality in qualities:
+        camera = cameras.ReplayCamera(frames, realtime=True)
+        provider = sensor_analysis.ImageProvider(camera, quality=quality)
+        provider.start(feature)
+        try:
+            ticks = 0
+            start = time.time()
+            while time.time() - start < duration:
+                provider.get_features()
+                ticks += 1
+            elapsed = time.time() - start
+        finally:
+            provider.end()
+            camera.close()
+        results.append({
+            'quality': quality,
+            'feature': feature,
+            'detection_fps': provider.analyzed / elapsed,
+            'timeouts': provider.timeouts,
+            'loop_ticks_per_second': ticks / elapsed,
+        })
+    return results
+
+
+def bench_control_loop(bauds=(9600, 115200), duration=10):
+    '''Measures the state machine driving the simulated robot.'''
+    results = []
+    for baud in bauds:
+        stats = simulator.run(duration, baud=baud)
+        results.append({
+            'baud': baud,
+            'ticks_per_second': stats['ticks_per_second'],
+            'commands_per_tick': stats['commands'] / stats['ticks'],
+            'bytes_per_command': stats['bytes_per_command'],
+            'serial_busy_fraction': stats['busy_time'] / stats['elapsed'],
+        })
+    return results
+
+
+def bench_dashboard(frames, viewers=VIEWERS, duration=10, port=5000):
+    '''Measures how many webcam frames each dashboard viewer receives.'''
+    try:
+        import websocket
+    except ImportError:
+        return {'skipped': 'websocket-client is not installed'}
+
+    camera = cameras.ReplayCamera(frames, realtime=True)
+    image_queue = multiprocessing.Queue(maxsize=1)
+    board = dashboard.Dashboard(
+        'benchmark',
+        multiprocessing.Manager().dict(),
+        multiprocessing.Queue(),
+        image_queue,
+        camera.size,
+        port=port)
+    board.start()
+
+    running = [True]
+    def feed():
+        while running[0]:
+            raw = camera.get_raw()
+            if image_queue.empty():
+                image_queue.put(raw)
+            time.sleep(1 / 30)
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    def watch(counts, index, stop):
+        connection = websocket.create_connection(
+            'ws://127.0.0.1:{0}/camera?token={1}'.format(port, board.token), timeout=2)
+        try:
+            while time.time() < stop:
+                try:
+                    connection.recv()
+                    counts[index] += 1
+                except websocket.WebSocketTimeoutException:
+                    pass
+        finally:
+            connection.close()
+
+    results = []
+    try:
+        # Give the server a moment to start listening.
+        time.sleep(2)
+        for num_viewers in viewers:
+            counts = [0] * num_viewers
+            stop = time.time() + duration
+            threads = [
+                threading.Thread(target=watch, args=(counts, i, stop))
+                for i in range(num_viewers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results.append({
+                'viewers': num_viewers,
+                'fps_per_viewer': [count / duration for count in counts],
+                'total_fps': sum(counts) / duration,
+            })
+    finally:
+        running[0] = False
+        board.terminate()
+        camera.close()
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(frames, duration=10):
+    '''Runs every benchmark and returns the results as a dict.'''
+    return {
+        'metadata': {
+            'time': datetime.now().isoformat(),
+            'revision': get_revision(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': multiprocessing.cpu_count(),
+            'frames': frames,
+        },
+        'detection': bench_detection(frames, duration=duration / 2),
+        'image_provider': bench_image_provider(frames, duration=duration),
+        'control_loop': bench_control_loop(duration=duration),
+        'dashboard': bench_dashboard(frames, duration=duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the robot.')
+    parser.add_argument('frames', help='a directory of frames recorded with --record-frames')
+    parser.add_argument('--output', default='benchmark.json', help='where to save the results')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run each benchmark')
+    args = parser.parse_args()
+
+    results = run(args.frames, args.duration)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=4, sort_keys=True)
+    print 'Saved results to ' + args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+'''
+# cameras.py #
+
+
+## About ##
+
+This module is part of the hardware layer, and contains the different
+places frames can come from. Anything with a `getImage` method that
+returns a SimpleCV `Image` can be used as a camera, so the rest of the
+code doesn't need to care whether the frames come from a real webcam
+or from a file on disk.
+
+There are currently three kinds of "cameras":
+
+-   A real webcam (a SimpleCV `Camera` object).
+-   `FrameRecorder`, which wraps another camera and saves every frame
+    it returns to disk, along with the time it was taken.
+-   `ReplayCamera`, which plays back frames saved by a `FrameRecorder`,
+    either at the same speed they were recorded at or as fast as
+    possible.
+
+This lets us record a session at an event and then test and tune the
+vision code on a machine without a webcam, getting the exact same
+frames every time.
+
+Use `open_camera` to get the right kind of camera, or better yet, get
+frames through `SERVICE` (see "Sharing cameras", below).
+
+
+## Capturing in the background ##
+
+Grabbing a frame from a webcam blocks until the driver hands one over,
+which can take a good fraction of a tick. Worse, if we don't grab frames
+often enough, the driver queues them up, and we end up looking at what
+happened a second ago.
+
+`CaptureThread` wraps any camera and grabs frames from it as fast as the
+camera can give them in a background thread, keeping only the newest
+one. Calling `latest` returns that frame straight away, along with the
+time it was taken and a sequence number that goes up by one for every
+new frame, so callers can tell whether they've already seen it.
+
+
+## Sharing cameras ##
+
+Lots of things want frames from the same webcam: the detector, the
+dashboard, the debug view, and so on. A webcam can only be opened once,
+and grabbing a frame for each of them would be a waste anyway.
+
+`SERVICE` (a `CameraService`) owns every camera in this process, each 
+read by a single `CaptureThread`. Anything that wants frames calls 
+`SERVICE.subscribe(index)` to get a `Subscriber`, which hands out each
+new frame once, no faster than the rate it asked for. Every subscriber
+sees the same frames, and no frame is ever grabbed twice.
+
+
+## The recording format ##
+
+A recording is a directory containing three files:
+
+-   `meta.json`, which contains the size of the frames.
+-   `frames.raw`, which contains every frame one after the other as raw
+    RGB bytes (the same format as `Image.toString()`).
+-   `timestamps.raw`, which contains the time each frame was taken as
+    an array of 8-byte little-endian doubles.
+
+Since every frame is the same size, frame number `n` always starts at
+byte `n * width * height * 3`. When replaying, the frames file is
+[memory-mapped][mm], so grabbing a frame doesn't need to decode or even
+read anything until it's actually used.
+
+  [mm]: http://docs.python.org/2/library/mmap.html
+
+Raw frames are big (about 1 MB each at 640x480), so recording writes
+frames from a separate thread and drops frames if the disk can't keep
+up rather than slowing down the robot.
+
+
+## Dependencies ##
+
+*   This module uses a 3rd party library called [SimpleCV][sc]
+
+  [sc]: http://www.simplecv.org/
+'''
+
+from __future__ import division
+
+import array
+import bisect
+import json
+import mmap
+import os
+import Queue
+import sys
+import threading
+import time
+
+import SimpleCV as scv
+
+def image_from_string(raw, size):
+    '''
+    Converts a raw RGB string (produced by `Image.toString()`) back into a
+    SimpleCV `Image` object of the given (width, height).
+    '''
+    bmp = scv.cv.CreateImageHeader(size, scv.cv.IPL_DEPTH_8U, 3)
+    scv.cv.SetData(bmp, raw)
+    scv.cv.CvtColor(bmp, bmp, scv.cv.CV_RGB2BGR)
+    return scv.Image(bmp)
+
+
+class FrameRecorder(object):
+    '''
+    Wraps a camera and records every frame it returns to `directory`.
+    '''
+    def __init__(self, camera, directory, max_pending=30):
+        self.camera = camera
+        self.directory = directory
+        self.size = None
+        self.frames = 0
+        self.dropped = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._frames_file = open(os.path.join(directory, 'frames.raw'), 'wb')
+        self._timestamps_file = open(os.path.join(directory, 'timestamps.raw'), 'wb')
+
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._writer = threading.Thread(target=self._write_loop, name='frame-recorder')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def getImage(self):
+        image = self.camera.getImage()
+        if self.size is None:
+            self.size = image.size()
+            with open(os.path.join(self.directory, 'meta.json'), 'w') as meta:
+                json.dump({'width': self.size[0], 'height': self.size[1]}, meta)
+        if image.size() == self.size:
+            try:
+                self._queue.put_nowait((time.time(), image.toString()))
+                self.frames += 1
+            except Queue.Full:
+                self.dropped += 1
+        return image
+
+    def close(self):
+        self._queue.put((None, None))
+        self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            timestamp, raw = self._queue.get()
+            if raw is None:
+                break
+            self._frames_file.write(raw)
+            stamp = array.array('d', [timestamp])
+            if sys.byteorder == 'big':
+                stamp.byteswap()
+            self._timestamps_file.write(stamp.tostring())
+        self._frames_file.close()
+        self._timestamps_file.close()
+
+
+class ReplayCamera(object):
+    '''
+    Plays back a recording made by `FrameRecorder`.
+
+    If `realtime` is True, `getImage` returns whichever frame was being
+    recorded at the same point in time, just like a real camera would
+    (if you call it too slowly, frames get skipped). Otherwise, every
+    call returns the next frame, as fast as you can call it.
+
+    If `loop` is True, the recording starts over once it runs out.
+    Otherwise, `getImage` keeps returning the last frame.
+    '''
+    def __init__(self, directory, realtime=True, loop=True):
+        self.directory = directory
+        self.realtime = realtime
+        self.loop = loop
+
+        with open(os.path.join(directory, 'meta.json')) as meta:
+            info = json.load(meta)
+        self.size = (info['width'], info['height'])
+        self.frame_size = self.size[0] * self.size[1] * 3
+
+        self.timestamps = array.array('d')
+        with open(os.path.join(directory, 'timestamps.raw'), 'rb') as timestamps:
+            self.timestamps.fromstring(timestamps.read())
+        if sys.byteorder == 'big':
+            self.timestamps.byteswap()
+
+        self._frames_file = open(os.path.join(directory, 'frames.raw'), 'rb')
+        self._frames = mmap.mmap(self._frames_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = min(len(self.timestamps), len(self._frames) // self.frame_size)
+        if self.count == 0:
+            raise ValueError('The recording in {0} has no frames'.format(directory))
+
+        self.position = -1
+        self.start = None
+
+    def next_position(self):
+        '''Works out which frame should be returned next.'''
+        if not self.realtime:
+            position = self.position + 1
+            if position >= self.count:
+                position = 0 if self.loop else self.count - 1
+            return position
+
+        if self.start is None:
+            self.start = time.time()
+        elapsed = time.time() - self.start
+        duration = self.timestamps[self.count - 1] - self.timestamps[0]
+        if self.loop and duration > 0:
+            elapsed = elapsed % duration
+        target = self.timestamps[0] + elapsed
+        position = bisect.bisect_right(self.timestamps, target, 0, self.count) - 1
+        return max(0, min(self.count - 1, position))
+
+    def get_raw(self):
+        '''Returns the next frame as a raw RGB string.'''
+        self.position = self.next_position()
+        offset = self.position * self.frame_size
+        return self._frames[offset:offset + self.frame_size]
+
+    def getImage(self):
+        return image_from_string(self.get_raw(), self.size)
+
+    def close(self):
+        self._frames.close()
+        self._frames_file.close()
+
+
+class CaptureThread(object):
+    '''
+    Grabs frames from `camera` in a background thread, keeping only the 
+    newest one. See "Capturing in the background", above.
+    
+    A `CaptureThread` can also be used as a camera itself: `getImage` 
+    returns the newest frame, waiting only if there hasn't been a frame 
+    yet.
+    '''
+    def __init__(self, camera, name='capture'):
+        self.camera = camera
+        self.errors = 0
+        
+        self._condition = threading.Condition()
+        self._latest = (None, None, 0)
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def _capture_loop(self):
+        while self._running:
+            try:
+                image = self.camera.getImage()
+            except Exception:
+                # A camera that's been unplugged (or a broken frame) 
+                # shouldn't kill the thread.
+                self.errors += 1
+                time.sleep(0.1)
+                continue
+            timestamp = time.time()
+            with self._condition:
+                self._latest = (image, timestamp, self._latest[2] + 1)
+                self._condition.notify_all()
+                
+    def latest(self):
+        '''
+        Returns the newest frame as an (image, timestamp, sequence) tuple
+        without waiting. Before the first frame arrives, this returns 
+        (None, None, 0).
+        '''
+        with self._condition:
+            return self._latest
+            
+    def wait(self, after=0, timeout=None):
+        '''
+        Waits until there's a frame with a sequence number bigger than 
+        `after` (or `timeout` seconds pass), and returns the newest frame
+        like `latest` does.
+        '''
+        with self._condition:
+            if self._latest[2] <= after:
+                self._condition.wait(timeout)
+            return self._latest
+            
+    def getImage(self):
+        image, timestamp, sequence = self.latest()
+        while image is None and self._running:
+            image, timestamp, sequence = self.wait(timeout=1)
+        return image
+        
+    def close(self):
+        self._running = False
+        self._thread.join(2)
+        if hasattr(self.camera, 'close'):
+            self.camera.close()
+
+
+class Subscriber(object):
+    '''
+    Gets frames from a `CaptureThread`, at most `rate` times a second (or 
+    as often as there are new frames, if `rate` is None).
+    
+    A `Subscriber` can also be used as a camera: `getImage` returns the 
+    newest frame, waiting only if there hasn't been a frame yet.
+    '''
+    def __init__(self, capture, rate=None):
+        self.capture = capture
+        self.interval = 1 / rate if rate else 0
+        self.sequence = 0
+        self.last = 0
+        
+    def poll(self):
+        '''
+        Returns the newest frame as an (image, timestamp, sequence) tuple 
+        if there's a frame this subscriber hasn't seen and it's been long 
+        enough since the last one. Otherwise, returns None straight away.
+        '''
+        if time.time() - self.last < self.interval:
+            return None
+        frame = self.capture.latest()
+        if frame[0] is None or frame[2] == self.sequence:
+            return None
+        self.sequence = frame[2]
+        self.last = time.time()
+        return frame
+        
+    def getImage(self):
+        frame = self.capture.latest()
+        while frame[0] is None:
+            frame = self.capture.wait(timeout=1)
+        self.sequence = frame[2]
+        self.last = time.time()
+        return frame[0]
+        
+        
+class CameraService(object):
+    '''
+    Owns every camera in this process. See "Sharing cameras", above.
+    '''
+    def __init__(self):
+        self.captures = {}
+        self._lock = threading.RLock()
+        
+    def add(self, index, camera):
+        '''
+        Makes `camera` the camera at `index`, and returns the 
+        `CaptureThread` reading from it.
+        '''
+        with self._lock:
+            if not isinstance(camera, CaptureThread):
+                camera = CaptureThread(camera, name='capture-{0}'.format(index))
+            self.captures[index] = camera
+            return camera
+            
+    def open(self, index, replay=None, record=None, realtime=True):
+        '''
+        Returns the `CaptureThread` for the camera at `index`, opening it 
+        (see `open_camera`) if nothing has opened it yet.
+        '''
+        with self._lock:
+            if index not in self.captures:
+                self.add(index, open_camera(index, replay, record, realtime))
+            return self.captures[index]
+            
+    def subscribe(self, index, rate=None):
+        '''Returns a `Subscriber` for the camera at `index`, opening it if
+        needed.'''
+        return Subscriber(self.open(index), rate)
+        
+    def close(self, index=None):
+        '''Closes the camera at `index`, or every camera if `index` is 
+        None.'''
+        with self._lock:
+            indexes = list(self.captures) if index is None else [index]
+            for index in indexes:
+                capture = self.captures.pop(index, None)
+                if capture is not None:
+                    capture.close()
+                    
+                    
+SERVICE = CameraService()
+
+
+def open_camera(index, replay=None, record=None, realtime=True):
+    '''
+    Returns a camera.
+
+    If `replay` is a directory, frames are played back from there instead
+    of coming from the webcam at `index`. If `record` is a directory,
+    every frame is recorded there.
+    '''
+    if replay is not None:
+        camera = ReplayCamera(replay, realtime=realtime)
+    else:
+        camera = scv.Camera(index)
+    if record is not None:
+        camera = FrameRecorder(camera, record)
+    return camera
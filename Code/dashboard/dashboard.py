@@ -11,6 +11,10 @@ To get information, go to:
 
     ip_address:5000
 
+The first time, add the dashboard's password (its "token") to the end of 
+the address, like `ip_address:5000/?token=...`. The main program prints 
+the address to use when it starts. After that, the browser remembers it.
+
 For the video stream (which will heavily stress the server):
 
     ip_address:5000/webcam
@@ -21,6 +25,34 @@ To control the robot:
 
 ## Confusing bits ##
 
+The dashboard runs in its own process. Flask, gevent and SimpleCV are only
+imported once that process starts (inside `setup` and `run`), so that the
+main program doesn't have to wait for them to load when it starts up.
+
+Most changes to the robot's state are sent to the main program through the
+`mailbox` queue, which it empties once a tick. The joystick on the control
+page is different: it's moved around constantly, and only its latest 
+position matters. The control page keeps a WebSocket open to 
+`/control/ws` and sends each position as a short `seq,straight,rotate` 
+message (like `12,0.5,-0.25`), which is written straight into the shared 
+`joystick` array as (count, straight, rotate). The main program reads the 
+array every tick, and `count` goes up by one with every new position, so 
+it can tell when something changed. Messages that arrive out of order 
+(with a `seq` no bigger than the last one) are ignored.
+
+Anyone on the network can reach the dashboard, so it guards the robot 
+before anything gets near the main program:
+
+-   Every request needs the token, either as `?token=...` or from the 
+    cookie that's set the first time it's given. The joystick's WebSocket
+    is checked once, when it connects.
+-   Each client gets a `TokenBucket` for requests and another for 
+    joystick messages; once a client runs out, anything else it sends is
+    turned away (or, for the joystick, dropped) until the bucket refills.
+    Letting go of the joystick is never dropped while the robot is being
+    driven.
+-   Only the keys in `WRITABLE` can be changed.
+
 ## Dependencies ##
 
 ## Up next ##
@@ -29,31 +61,141 @@ After reading this file, move to `errors.py`
 '''
 
 import multiprocessing
+import binascii
 import json
+import math
+import os
 import traceback
 import cStringIO
 import time
 
-import flask
-from geventwebsocket.handler import WebSocketHandler
-from gevent.pywsgi import WSGIServer
-import SimpleCV as scv
+# The only parts of the robot's state the dashboard is allowed to change.
+WRITABLE = ('straight', 'rotate', 'manual', 'button')
+
+# How many requests (and joystick messages) a second each client may 
+# send, and how many it can send in a burst.
+REQUEST_LIMIT = (20, 40)
+JOYSTICK_LIMIT = (50, 50)
+
+
+def make_token():
+    '''Returns a random token that's hard to guess.'''
+    return binascii.hexlify(os.urandom(8))
+    
+    
+def same_token(a, b):
+    '''Compares two tokens without giving away how much of them matched
+    by how long it took.'''
+    if a is None or len(a) != len(b):
+        return False
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+
+class TokenBucket(object):
+    '''
+    Lets something happen `rate` times a second on average, and up to 
+    `burst` times in a row.
+    
+    The bucket holds up to `burst` tokens and refills at `rate` tokens a 
+    second. Each time `take` is called, it uses up a token if there is 
+    one and returns True, or returns False if the bucket is empty.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        
+    def take(self, now=None):
+        if now is None:
+            now = time.time()
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
 
 class Dashboard(multiprocessing.Process):
-    def __init__(self, name, data, mailbox, image_queue, image_size):
+    def __init__(self, name, data, mailbox, image_queue, image_size, joystick=None,
+            token=None, port=5000):
+        '''
+        `token` is the password needed to use the dashboard. If it's None,
+        a random one is made up (see `url`). The dashboard listens on 
+        `port`.
+        '''
         super(Dashboard, self).__init__(name=name)
         self.data = data
         self.mailbox = mailbox
         self.image_queue = image_queue
         self.image_size = image_size
+        self.joystick = joystick
+        self.token = token if token else make_token()
+        self.port = port
+        self.buckets = {}
+        
+    def url(self, host='localhost'):
+        '''Returns the address to visit to log in to the dashboard.'''
+        return 'http://{0}:{1}/?token={2}'.format(host, self.port, self.token)
+        
+    def allow(self, client, kind, limit):
+        '''Returns True if `client` hasn't used up its `kind` bucket.'''
+        key = (client, kind)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*limit)
+        return self.buckets[key].take()
+        
+    def move_joystick(self, straight, rotate):
+        '''Sets the joystick position the main program sees next tick.'''
+        with self.joystick.get_lock():
+            self.joystick[0] += 1
+            self.joystick[1] = straight
+            self.joystick[2] = rotate
         
     def setup(self):
+        import flask
+        import SimpleCV as scv
+        
         def make_safe(thing):
-            return json.loads(json.dumps(thing, default=lambda x: "(HIDDEN)"))
+            # Objects that know how to turn themselves into lists (like 
+            # `sensor_analysis.Detections`) are shown; anything else is hidden.
+            def convert(x):
+                return x.to_list() if hasattr(x, 'to_list') else "(HIDDEN)"
+            return json.loads(json.dumps(thing, default=convert))
     
         def app_factory():
             app = flask.Flask(self.name)
             
+            @app.before_request
+            def guard():
+                request = flask.request
+                if request.endpoint == 'static':
+                    return None
+                given = request.args.get('token')
+                if same_token(given, self.token):
+                    flask.g.remember_token = True
+                elif not same_token(request.cookies.get('token'), self.token):
+                    return flask.jsonify({
+                        "success": False,
+                        "reason": "add ?token=... to the address"
+                    }), 401
+                if not self.allow(request.remote_addr, 'requests', REQUEST_LIMIT):
+                    return flask.jsonify({
+                        "success": False,
+                        "reason": "too many requests"
+                    }), 429
+                return None
+                
+            @app.after_request
+            def remember(response):
+                if getattr(flask.g, 'remember_token', False):
+                    response.set_cookie('token', self.token, httponly=True)
+                return response
+            
             @app.route('/', methods=['GET'])
             def index():
                 return flask.render_template('index.html', name="Dashboard :: Niftybot")
@@ -78,7 +220,7 @@ class Dashboard(multiprocessing.Process):
             @app.route('/state/<name>', methods=['GET', 'PUT'])
             def set_state(name):
                 try:
-                    if name not in self.data.keys():
+                    if name not in self.data:
                         return flask.jsonify({
                             "success": False, 
                             "reason": "could not find {0}".format(name)
@@ -89,6 +231,12 @@ class Dashboard(multiprocessing.Process):
                             name: self.data[name]}))
                     else:
                         data = flask.request.json['data']
+                        for name, value in data:
+                            if name not in WRITABLE:
+                                return flask.jsonify({
+                                    "success": False, 
+                                    "reason": "{0} can't be changed".format(name)
+                                }), 403
                         for name, value in data:
                             self.mailbox.put_nowait([name, value])
                         return flask.jsonify({"success": True})
@@ -97,6 +245,50 @@ class Dashboard(multiprocessing.Process):
                     print error
 
 
+            @app.route('/control/ws')
+            def control_socket():
+                ws = flask.request.environ.get('wsgi.websocket')
+                if ws is None or self.joystick is None:
+                    return flask.jsonify({
+                        "success": False,
+                        "reason": "expected a websocket"
+                    })
+                client = flask.request.remote_addr
+                last_seq = -1
+                moving = False
+                try:
+                    while True:
+                        message = ws.receive()
+                        if message is None:
+                            break
+                        try:
+                            seq, straight, rotate = message.split(',')
+                            seq = int(seq)
+                            straight, rotate = float(straight), float(rotate)
+                        except ValueError:
+                            continue
+                        if seq <= last_seq or math.isnan(straight) or math.isnan(rotate):
+                            continue
+                        # Letting go of the joystick uses up a token like 
+                        # anything else, but still gets through when the 
+                        # bucket is empty if it actually stops the robot.
+                        stopping = straight == 0 and rotate == 0
+                        if (not self.allow(client, 'joystick', JOYSTICK_LIMIT) and 
+                                not (stopping and moving)):
+                            continue
+                        straight = max(-1.0, min(1.0, straight))
+                        rotate = max(-1.0, min(1.0, rotate))
+                        last_seq = seq
+                        moving = not stopping
+                        self.move_joystick(straight, rotate)
+                except:
+                    error = traceback.format_exc()
+                    print error
+                finally:
+                    # Don't keep driving if the browser goes away.
+                    self.move_joystick(0.0, 0.0)
+                return ''
+
             @app.route('/camera')
             def camera():
                 try:
@@ -130,6 +322,9 @@ class Dashboard(multiprocessing.Process):
         self.app = app_factory()
         
     def run(self):
+        from geventwebsocket.handler import WebSocketHandler
+        from gevent.pywsgi import WSGIServer
+        
         self.setup()
     
         # Normally, when the app has no parameters, it runs only on
@@ -146,7 +341,7 @@ class Dashboard(multiprocessing.Process):
         #self.server = cherrypy.wsgiserver.CherryPyWSGIServer((host, port), dispatcher)
         #self.server.start()
         
-        self.server = WSGIServer(('', 5000), self.app, handler_class=WebSocketHandler)
+        self.server = WSGIServer(('', self.port), self.app, handler_class=WebSocketHandler)
         self.server.serve_forever()
         
     def send_command(self, command, data):
@@ -161,6 +356,9 @@ def run_independently(name='Dashboard', host='0.0.0.0', debug=True):
     print "Any attempts to control the robot will go ignored."
     print ""
     
+    from geventwebsocket.handler import WebSocketHandler
+    from gevent.pywsgi import WSGIServer
+    
     dashboard = Dashboard(name, {"test": "value"}, multiprocessing.Queue())
     dashboard.setup()
 
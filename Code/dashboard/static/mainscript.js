@@ -102,6 +102,52 @@ function updateData(data) {
     });
 }
 
+// Sends joystick positions over a WebSocket that stays open, as 
+// "seq,straight,rotate" messages (see `dashboard.py`). If the socket isn't
+// open (or the browser doesn't support them), falls back to `updateData`.
+function openJoystick() {
+    var joystick = {"seq": 0, "socket": null, "lastSent": 0};
+
+    var connect = function() {
+        if (!("WebSocket" in window)) {
+            return;
+        }
+        var socket = new WebSocket("ws://" + document.domain + ":5000/control/ws");
+        socket.onclose = function() {
+            joystick.socket = null;
+            window.setTimeout(connect, 1000);
+        };
+        socket.onopen = function() {
+            joystick.seq = 0;
+            joystick.socket = socket;
+        };
+    };
+    connect();
+
+    joystick.send = function(straight, rotate) {
+        // The dashboard only accepts so many messages a second, so don't
+        // send every single mouse movement. Letting go is always sent.
+        // Without the socket, every position is a whole request, and 
+        // requests share a tighter limit with the page's polling.
+        var wait = joystick.socket !== null ? 40 : 100;
+        var now = new Date().getTime();
+        if (now - joystick.lastSent < wait && (straight != 0 || rotate != 0)) {
+            return;
+        }
+        joystick.lastSent = now;
+        if (joystick.socket !== null) {
+            joystick.seq += 1;
+            joystick.socket.send(joystick.seq + "," + straight + "," + rotate);
+        } else {
+            updateData([
+                ["straight", straight],
+                ["rotate", rotate]
+            ]);
+        }
+    };
+    return joystick;
+}
+
 function calculateRelativePosition(canvasObj, pos) {
     return {
         "x": pos.x / canvasObj.width * 2 - 1,
@@ -142,6 +188,7 @@ function setupControls() {
         "centery": canvas.width/2
     };
     
+    var joystick = openJoystick();
     var isClicked = false;
     var position = {"x": 0, "y": 0, "original": {
         "x": canvasObj.centerx, 
@@ -156,6 +203,8 @@ function setupControls() {
         position = calculateRelativePosition(
             canvasObj,
             getPosition(event));
+        drawManual(canvasObj, position);
+        joystick.send(position.y, position.x);
     }
     
     $('#' + htmlId).mousedown(function() { isClicked = true; });
@@ -167,25 +216,20 @@ function setupControls() {
             "y": canvasObj.centery
         }};
 
-        updateData([
-            ["straight", position.y],
-            ["rotate", position.x]
-        ]);
+        joystick.send(position.y, position.x);
         drawManual(canvasObj, position);
     });
 
     $("#" + htmlId).mousemove(handlePress);
 
+    // Keep repeating the position while it's held, so the robot knows
+    // we're still here (see `robot_actions.Watchdog`).
     window.setInterval(function() {
         if (position.x == 0 && position.y == 0) {
             return;
         }
 
-        drawManual(canvasObj, position);
-        updateData([
-            ["straight", position.y],
-            ["rotate", position.x]
-        ]);
+        joystick.send(position.y, position.x);
     }, 100);
 }
 
@@ -206,6 +250,33 @@ function toggleManual(htmlId) {
     });
 }
 
+function updateButtons(htmlId) {
+    var shown = null;
+    var callback = function() {
+        $.getJSON(url + "/state/buttons")
+            .done(function(data) {
+                if (!data.success) {
+                    return;
+                }
+                var labels = data.buttons.join("\n");
+                if (labels === shown) {
+                    return;
+                }
+                shown = labels;
+                $(htmlId).empty();
+                $.each(data.buttons, function(index, label) {
+                    $("<div class='button off'></div>")
+                        .text(label)
+                        .click(function() {
+                            updateData([["button", label]]);
+                        })
+                        .appendTo(htmlId);
+                });
+            });
+    };
+    window.setInterval(callback, 500);
+}
+
 function updateVideo(htmlId) {
     if ("WebSocket" in window) {
         var cam = new WebSocket("ws://" + document.domain + ":5000/camera");
@@ -24,6 +24,12 @@ Note: each class must implement a `startup` method, a `loop` method which is
 repeatedly called (and runs the main logic and determines to stay in the current
 state or move on to the next one)
 
+Each state also has a `buttons` attribute listing the labels of the buttons
+it shows on screen. A button can be pressed either by clicking on it on the
+screen, or by sending its label as `button` from the dashboard (which is the 
+only way to press one when running headless, without a screen). Either way, 
+the state's `press` method is called with the label.
+
 
 ## Dependencies ##
 
@@ -44,7 +50,6 @@ import socket
 
 import sensor_analysis
 import robot_actions
-import drawing
 
 class StartupState(object):
     '''Displays startup info.'''
@@ -53,6 +58,7 @@ class StartupState(object):
         self.message = 'Displaying startup info.'
         self.robot = robot
         self.wait_time = 30
+        self.buttons = ('Continue',)
 
     def startup(self):
         self.robot.set_speed(0, 0)
@@ -65,17 +71,20 @@ class StartupState(object):
         if time.time() - self.start > self.wait_time:
             return 'waiting'
 
+    def press(self, button):
+        self.proceed = True
+
     def draw(self, data, window):
         window.draw_mood('aqua')
         window.draw_text(
             'Webserver address:',
             socket.gethostbyname(socket.gethostname()) + ':5000',
             'Starting in {0:.1f} sec'.format(self.wait_time - (time.time() - self.start)))
-        buttons = drawing.make_buttons(window, "Continue")
+        buttons = window.make_buttons(*self.buttons)
         for button in buttons:
             window.draw_button(button)
             if button.is_pressed(data.get('mousepress', [0, 0])):
-                self.proceed = True
+                self.press(button.text)
             if self.proceed:
                 window.draw_filled_button(button)
 
@@ -89,6 +98,7 @@ class WaitingState(object):
         self.name = 'waiting'
         self.message = 'Searching for person'
         self.robot = robot
+        self.buttons = ()
         
     def startup(self):
         '''time.sleep(1)
@@ -98,8 +108,10 @@ class WaitingState(object):
         self.robot.stop()
         
     def loop(self, data):
+        # Spin in place until somebody shows up. Don't wait around in 
+        # here: nothing else runs until this returns, and the `Watchdog`
+        # stops the robot if a tick takes too long.
         self.robot.set_left_speed(0.9)
-        time.sleep(1)
         
         if len(data.get('humans', [])) > 0:
             return "approach"
@@ -114,16 +126,30 @@ class WaitingState(object):
         pass
         
 class ApproachState(object):
-    '''Give a human, rotate the robot to face it and approaches it.'''
+    '''
+    Give a human, rotate the robot to face it and approaches it.
+    
+    If there's more than one person in view, the robot follows the one in
+    `data['target']` (picked by `sensor_analysis.Tracker`), or the biggest
+    one if nobody was picked, rather than driving into the empty space 
+    between them.
+    
+    The robot steers and slows down smoothly using `Robot.track`, and 
+    stops `STOP_DISTANCE` meters away from the person.
+    '''
+    STOP_DISTANCE = 0.8
+    
     def __init__(self, robot):
         self.name = 'approach'
         self.message = 'Approaching person'
         self.robot = robot
+        self.buttons = ('Yes', 'No')
         
     def startup(self):
         self.pressed = None
         self.pressed_time = None
         self.x_offset = 0
+        self.robot.reset_tracking()
 
     def loop(self, data):
         if self.pressed is not None:
@@ -136,40 +162,40 @@ class ApproachState(object):
             else:
                 return 'backoff'
 
-        humans = data.get('humans', [])
-        centroid = sensor_analysis.get_centroid(humans)
+        humans = sensor_analysis.as_detections(data.get('humans', []))
         if len(humans) == 0:
             return 'waiting'
+        target = data.get('target')
+        if target is None:
+            target = humans.largest()
             
-        self.x_offset = centroid[0]
+        self.x_offset = target['center_x']
 
         self.center = data.get('image_size', [640, 480])
         width = self.center[0]
         height = self.center[1]                
 
-        max_human_width = 0
-        max_human_height = 0
-        
-        for human in humans:
-            if human["height"] > max_human_height:
-                max_human_height = human["height"]
-        
-        #if max_human_height > height*0.8:
-        #    self.robot.stop()   
-        #    self.message = "Stopped - someone is nearby"
+        # How far away the person is in meters, or None if we can't tell
+        # (see `sensor_analysis.CameraCalibration`).
+        distance = target.get('range')
         
-        if True:
-            if self.x_offset < width * 0.4:
-                self.robot.set_left_speed(1)
+        if distance is not None and distance <= self.STOP_DISTANCE:
+            self.robot.stop()   
+            self.robot.reset_tracking()
+            self.message = "Stopped - someone is nearby"
+        else:
+            # From -1 (left edge) to 1 (right edge).
+            x_error = (self.x_offset - width / 2.0) / (width / 2.0)
+            range_error = None if distance is None else distance - self.STOP_DISTANCE
+            self.robot.track(x_error, range_error)
+            if x_error < -0.2:
                 self.message = "Rotate left"
-            elif self.x_offset > width * 0.6:
-                self.robot.set_right_speed(1)
+            elif x_error > 0.2:
                 self.message = "Rotate right"
             else:
-                self.robot.set_forward_speed(1)
                 self.message = "Go forward"
 
-        self.y_offset = centroid[1]
+        self.y_offset = target['center_y']
 
         if self.y_offset < height*0.35:
             pass
@@ -182,6 +208,9 @@ class ApproachState(object):
         else:
             pass
         
+    def press(self, button):
+        self.pressed = button
+        
     def draw(self, data, window):
         window.draw_mood('green')
 
@@ -191,11 +220,11 @@ class ApproachState(object):
             window.draw_text('Let me know if', 'you change your mind!')
         else:
             window.draw_text('Would you like to', 'donate some money?')#, "Message: "+self.message)
-        buttons = drawing.make_buttons(window, "Yes", "No")
+        buttons = window.make_buttons(*self.buttons)
         for button in buttons:
             window.draw_button(button)
             if button.is_pressed(data.get('mousepress', [0, 0])):
-                self.pressed = button.text
+                self.press(button.text)
             if self.pressed == button.text:
                 window.draw_filled_button(button)
         return None
@@ -208,6 +237,7 @@ class BackOffState(object):
         self.name = 'backoff'
         self.message = 'Donation finished; backing off'
         self.robot = robot
+        self.buttons = ()
 
     def startup(self):
         self.robot.set_speed(0, 0)
@@ -231,10 +261,20 @@ class BackOffState(object):
 
         
 class ManualControlState(object):
+    '''
+    Drives the robot with the dashboard's joystick (`data['straight']` and
+    `data['rotate']`).
+    
+    The driver can't always see what's in front of the robot, so if 
+    `obstacle_ahead` is True, the forward part of the command is dropped 
+    (turning and backing up still work), and the robot is stopped 
+    straight away if it was driving forwards.
+    '''
     def __init__(self, robot):
         self.name = 'manual'
         self.message = 'Manually controlling robot.'
         self.robot = robot
+        self.buttons = ()
         
     def startup(self):
         self.robot.set_speed(0, 0)
@@ -243,6 +283,11 @@ class ManualControlState(object):
         straight = data.get('straight', 0)
         rotate = data.get('rotate', 0)
         
+        if straight > 0 and obstacle_ahead(data):
+            straight = 0
+            if self.robot.is_moving_forward():
+                self.robot.stop()
+        
         left_wheel = 0
         right_wheel = 0
         
@@ -269,10 +314,82 @@ class ManualControlState(object):
     def end(self):
         self.robot.set_speed(0, 0)
         
+
+def obstacle_ahead(data):
+    '''
+    Returns True if it isn't safe to drive forwards: either an obstacle is
+    closer than `AvoidObstacleState.STOP_DISTANCE` (`data['obstacle']`, see
+    `Robot.obstacle_distance`), or the rangefinders have gone silent 
+    (`data['sonar_blind']`, see `Robot.sonar_blind`).
+    '''
+    if data.get('sonar_blind', False):
+        return True
+    distance = data.get('obstacle')
+    return distance is not None and distance <= AvoidObstacleState.STOP_DISTANCE
+
+
+class AvoidObstacleState(object):
+    '''
+    Backs away from something the rangefinders spotted in front of the 
+    robot, then goes back to whatever it was doing before.
+    
+    This state is never returned by another state. Instead, `StateMachine`
+    switches to it as soon as `obstacle_ahead` is True while the robot is
+    driving forwards, and sets `resume` to the state to go back to once 
+    nothing is closer than `CLEAR_DISTANCE`. If the way doesn't clear up 
+    within `GIVE_UP_TIME` seconds, the robot goes back to waiting instead.
+    
+    If the rangefinders have gone silent, nobody knows what's around the
+    robot (and nothing is watching behind it anyway), so it stays where it
+    is until they come back rather than backing up blind.
+    '''
+    STOP_DISTANCE = 0.3
+    CLEAR_DISTANCE = 0.5
+    GIVE_UP_TIME = 10
+    
+    def __init__(self, robot):
+        self.name = 'avoid'
+        self.message = 'Avoiding obstacle'
+        self.robot = robot
+        self.buttons = ()
+        self.resume = None
+        
+    def startup(self):
+        self.robot.stop()
+        self.start = time.time()
+        
+    def loop(self, data):
+        if data.get('sonar_blind', False):
+            self.robot.stop()
+            self.message = 'Rangefinders silent; holding still'
+            self.start = time.time()
+            return None
+        distance = data.get('obstacle')
+        if distance is None or distance > self.CLEAR_DISTANCE:
+            return self.resume or 'waiting'
+        if time.time() - self.start > self.GIVE_UP_TIME:
+            return 'waiting'
+        self.message = 'Avoiding obstacle'
+        self.robot.set_backward_speed(0.4)
+        
+    def draw(self, data, window):
+        window.draw_mood('red')
+        window.draw_text('Excuse me!')
+        
+    def end(self):
+        self.robot.stop()
+        self.resume = None
+        
+        
 class StateMachine(object):
     '''
     This class is responsible for managing all the different states
     and state switching.
+    
+    If the `avoid` state exists, it also acts as a safety net: whenever 
+    `obstacle_ahead` is True while the robot is driving forwards, the 
+    robot is stopped before the current state even runs, and the machine
+    switches to `avoid`.
     '''
     def __init__(self, robot, start_state, states):
         self.robot = robot
@@ -285,7 +402,12 @@ class StateMachine(object):
         self.state.startup()
 
     def loop(self, data):
-        next = self.state.loop(data)
+        button = data.get('button')
+        if button is not None and button in self.state.buttons:
+            self.state.press(button)
+        next = self.intercept_obstacle(data)
+        if next is None:
+            next = self.state.loop(data)
         next = self.intercept_manual_control(data, next)
         if next is not None and next in self.states:
             self.state.end()
@@ -297,6 +419,17 @@ class StateMachine(object):
         self.state.draw(data, window)
         window.heartbeat()
             
+    def intercept_obstacle(self, data):
+        if 'avoid' not in self.states or self.state_name in ('avoid', 'manual'):
+            return None
+        if not obstacle_ahead(data):
+            return None
+        if not self.robot.is_moving_forward():
+            return None
+        self.robot.stop()
+        self.states['avoid'].resume = self.state_name
+        return 'avoid'
+            
     def intercept_manual_control(self, data, next):
         is_manual = data.get('manual', False)
         if is_manual and self.state_name != 'manual':
@@ -317,6 +450,7 @@ def startup(robot):
         'approach': ApproachState(robot),
         'manual': ManualControlState(robot),
         'backoff': BackOffState(robot),
+        'avoid': AvoidObstacleState(robot),
     }
     return StateMachine(robot, 'startup', states)
             
@@ -58,6 +58,9 @@ class Window(object):
             (255, 255, 255),
             button.rect)
         
+    def make_buttons(self, *text):
+        return make_buttons(self, *text)
+
     def heartbeat(self):
         pygame.display.flip()
 
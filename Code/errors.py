@@ -6,15 +6,17 @@ Contains code for last-resort error handling.
 import sys
 from datetime import datetime
 
-import Tkinter
-import tkMessageBox
-
 __version__ = "1.0.0"
 __release__ = "May 28, 2013"
 
 def error(message, record=False):
     '''Opens a window reporting an error. This is for when the program 
     is so borked that something has crashed in some way.'''
+    # Tkinter is slow to load, so it's only imported when something 
+    # actually goes wrong.
+    import Tkinter
+    import tkMessageBox
+    
     window = Tkinter.Tk()
     window.wm_withdraw()
     tkMessageBox.showerror('Error!', message)
@@ -89,6 +89,11 @@ handle emergency error-handling or logging. Basically, it contains code
 as part of a last-ditch effort to cleanly shut the program down and 
 generate a log when the program encounters an error that it cannot 
 recover from.
+
+Similarly, the `telemetry` module sits outside the heirarchy. It can 
+record every tick of the state machine to a compact binary file, so we
+can replay exactly what the robot saw and did after something goes 
+wrong. Run the program with `--record FILE` to turn it on.
   
   
 ## Up next... ##
@@ -101,20 +106,89 @@ the second (`sensor_analysis`), etc.
 # Note: the module name corresponds to the name of the file.
 # The code you write in `batman.py` can be accessed by doing
 # `import batman`.
+#
+# Most of the modules we wrote are imported inside `main` instead of up 
+# here. Importing them pulls in SimpleCV, OpenCV, pygame and friends, which
+# takes a good few seconds, so we'd rather do that while we're waiting for 
+# the Arduino to answer (see `HardwareDiscovery`).
 
 # These modules are part of Python's standard library
+import os
 import sys
+import threading
+import time
 import traceback
 
-# These modules are ones that we wrote
-import basic_hardware
-import sensor_analysis
-import robot_actions
-import decision_making
-import user_interface
-import errors
+# These modules are ones that we wrote. `telemetry` only uses the 
+# standard library, so it's quick to import.
+import telemetry
 
-import cv2
+def get_argument(name, default=None):
+    '''
+    Returns the value following `name` in the command line arguments.
+    For example, if the program was started with `--record run.bin`,
+    `get_argument('--record')` returns `'run.bin'`.
+    '''
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+class HardwareDiscovery(threading.Thread):
+    '''
+    Looks for the Arduino in the background.
+    
+    Finding the Arduino involves opening every serial port and waiting a 
+    couple of seconds for the board to reset before asking it what it is.
+    Doing that in a separate thread lets us import everything else at 
+    the same time.
+    
+    If no Arduino is found, `arduino` is left as None.
+    
+    Note: Python only lets one thread import modules at a time, so `connect`
+    must be imported before the thread starts, or the thread would have to 
+    wait for the main thread to finish importing everything else.
+    '''
+    def __init__(self, connect):
+        '''`connect` is a function which returns a connected Arduino.'''
+        super(HardwareDiscovery, self).__init__(name='hardware-discovery')
+        self.daemon = True
+        self.connect = connect
+        self.arduino = None
+        self.elapsed = 0
+        
+    def run(self):
+        start = time.time()
+        try:
+            self.arduino = self.connect("9600")
+        except Exception:
+            self.arduino = None
+        self.elapsed = time.time() - start
+
+def start(options, timer):
+    '''Finds the hardware, imports everything, and starts the robot.'''
+    discovery = None
+    if not options['simulate']:
+        # This only needs pyserial, so it's quick to import.
+        import arduino_modified as Arduino
+        discovery = HardwareDiscovery(Arduino.Arduino)
+        discovery.start()
+        
+    import basic_hardware
+    import user_interface
+    timer.mark('imports')
+    
+    if discovery is not None:
+        discovery.join()
+        timer.mark('waiting for the Arduino')
+        timer.record('finding the Arduino', discovery.elapsed)
+        if discovery.arduino is None:
+            options['arduino'] = basic_hardware.FakeArduino()
+        else:
+            options['arduino'] = discovery.arduino
+            
+    user_interface.main(timer=timer, **options)
 
 def main():
     '''
@@ -126,15 +200,64 @@ def main():
     
     It also contains last-ditch error handling. If the code throws an 
     exception, it will be caught and logged here.
+    
+    Command line options:
+    
+    -   `--noisy`: don't catch exceptions
+    -   `--record FILE`: record every tick of the state machine to `FILE`
+        (see `telemetry.py`)
+    -   `--record-frames DIR`: record every camera frame to `DIR`
+    -   `--replay DIR`: play back camera frames recorded in `DIR` instead
+        of using the webcam (see `cameras.py`)
+    -   `--fast`: when replaying, play frames back as fast as possible
+        instead of at the speed they were recorded at
+    -   `--simulate`: drive a simulated robot instead of the Arduino
+        (see `simulator.py`)
+    -   `--headless`: don't draw anything to the screen; on-screen buttons
+        are pressed from the dashboard's control page instead
+    -   `--calibration FILE`: load the camera calibration used to work out
+        how far away people are from `FILE` (see 
+        `sensor_analysis.CameraCalibration`)
+    -   `--motors FILE`: load the motor profiles from `FILE` (see 
+        `basic_hardware.MotorProfile` and `robot_actions.calibrate_motors`)
+    -   `--encoders`: stream the wheel encoders from the Arduino to keep 
+        track of where the robot is (needs a sketch that supports it)
+    -   `--sonar PINS`: stop before bumping into things, using the 
+        ultrasonic rangefinders plugged into the comma-separated `PINS`, 
+        like `--sonar 7,8` (needs a sketch that supports streaming; if 
+        the rangefinders go quiet, the robot won't drive forwards)
+    -   `--token TOKEN`: the password needed to use the dashboard. If 
+        this isn't given, the `NIFTYBOT_TOKEN` environment variable is 
+        used instead, and if that isn't set either, a random one is made
+        up and printed when the robot starts.
+        
+    When the robot starts, it prints how long each part of starting up 
+    took.
     '''
+    timer = telemetry.PhaseTimer()
+    options = {
+        'record': get_argument('--record'),
+        'record_frames': get_argument('--record-frames'),
+        'replay': get_argument('--replay'),
+        'realtime': '--fast' not in sys.argv,
+        'simulate': '--simulate' in sys.argv,
+        'headless': '--headless' in sys.argv,
+        'calibration': get_argument('--calibration'),
+        'motors': get_argument('--motors'),
+        'encoders': '--encoders' in sys.argv,
+        'sonar': [int(pin) for pin in get_argument('--sonar', '').split(',') if pin],
+        'token': get_argument('--token', os.environ.get('NIFTYBOT_TOKEN')),
+    }
     if "--noisy" in sys.argv:
-        user_interface.main()
+        start(options, timer)
     else:
         try:
-            user_interface.main()
+            start(options, timer)
         except SystemExit:
             pass
         except Exception:
+            # Only imported when needed, since it loads Tkinter.
+            import errors
             error = traceback.format_exc()
             errors.log('Top-level exception: ' + error)
             errors.error('The program encountered an unexpected error.\n\n' + 
@@ -15,9 +15,10 @@ This class is essentially a high-level interface to control a single robot.
 
 ## Confusing bits ##
 
-This module currently contains only a single `Robot` class. In the future, if 
-we make different robot variants, we should create a new class instead of modifying
-the current one.
+This module currently contains only a single `Robot` class (and a `PID` 
+controller it uses to steer, and a `Watchdog` which stops it if the 
+program freezes). In the future, if we make different robot variants, 
+we should create a new class instead of modifying the current one.
 
 
 ## Dependencies ##
@@ -37,6 +38,7 @@ After reading this file, move to `decision_making.py`.
 
 '''
 
+import threading
 import time
 import math
 
@@ -45,11 +47,106 @@ import sensor_analysis
 
 import arduino_modified as Arduino
 
+
+class PID(object):
+    '''
+    A [PID controller][pid], which works out how hard to push to get an 
+    error down to zero.
+    
+    The output is the sum of three terms:
+    
+    -   `kp` times the error (push harder the further off we are)
+    -   `ki` times the error added up over time (push harder if we've been
+        off for a while)
+    -   `kd` times how fast the error is changing (ease off if we're 
+        closing in quickly)
+        
+    The output is clamped to `limits`. While it's clamped, the error stops
+    being added up (this is called "anti-windup"); otherwise, after being 
+    stuck far away for a while, the controller would overshoot badly once
+    it finally got close.
+    
+      [pid]: http://en.wikipedia.org/wiki/PID_controller
+    '''
+    def __init__(self, kp, ki=0.0, kd=0.0, limits=(-1.0, 1.0)):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.limits = limits
+        self.reset()
+        
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+        self.last_time = None
+        
+    def update(self, error, now=None):
+        '''Returns the output for the current `error`.'''
+        if now is None:
+            now = time.time()
+        dt = 0.0 if self.last_time is None else max(0.0, now - self.last_time)
+        derivative = 0.0
+        if dt > 0 and self.last_error is not None:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        self.last_time = now
+        
+        integral = self.integral + error * dt
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        low, high = self.limits
+        if low <= output <= high:
+            self.integral = integral
+        return max(low, min(high, output))
+        
+
+def calibrate_motors(robot, measure, steps=10, settle=0.5):
+    '''
+    Measures how fast each of the robot's motors turns at `steps` 
+    different powers, and returns a `basic_hardware.MotorProfile` for 
+    each of them (as a dict, which can be saved with 
+    `basic_hardware.save_profiles`). The robot starts using the new 
+    profiles straight away.
+    
+    `measure` is a function that takes the side of a wheel ("left" or 
+    "right") and returns how fast it's turning right now. Each wheel is 
+    given `settle` seconds to get up to speed before it's measured.
+    
+    Note that the robot will drive in circles while this runs, so 
+    prop it up first.
+    '''
+    profiles = {}
+    for wheel in (robot.left_wheel, robot.right_wheel):
+        powers = [float(step) / steps for step in range(steps + 1)]
+        speeds = []
+        for power in powers:
+            wheel.set_power(power)
+            time.sleep(settle)
+            # Measurements are a bit noisy, but a motor never gets slower
+            # when given more power.
+            speeds.append(max([abs(measure(wheel.side))] + speeds))
+        wheel.stop()
+        profiles[wheel.side] = basic_hardware.MotorProfile(powers, speeds)
+    robot.set_profiles(profiles)
+    return profiles
+    
+
 class Robot(object):
-    def __init__(self, arduino=None, arm_servo=None, laptop_servo=None):
+    def __init__(self, arduino=None, arm_servo=None, laptop_servo=None, profiles=None,
+            encoders=False, sonar=None):
         '''
         Note: if this robot cannot connect to an Arduino, it 
         connects to a fake one instead.
+        
+        `profiles` is a dict containing a `basic_hardware.MotorProfile` for
+        the "left" and "right" motors. If it's None, the profiles in
+        `basic_hardware.DEFAULT_GAINS` are used.
+        
+        If `encoders` is True, the wheel encoders are streamed from the 
+        Arduino, and `odometry` keeps track of where the robot is. 
+        Otherwise, both `encoders` and `odometry` are None.
+        
+        `sonar` is a list of the pins ultrasonic rangefinders are plugged 
+        into (see `basic_hardware.Rangefinders` and `obstacle_distance`).
         '''
         if arduino is None:
             try:
@@ -60,7 +157,10 @@ class Robot(object):
                 self.kind = "Fake"
         else:
             self.arduino = arduino
-            self.kind = "Passed"
+            if isinstance(arduino, basic_hardware.FakeArduino):
+                self.kind = "Fake"
+            else:
+                self.kind = "Passed"
 
         # if arm_servo is None:            
         #    self.arm_servo = basic_hardware.Servo(self.arduino, 5)
@@ -76,10 +176,37 @@ class Robot(object):
         
         self.left_wheel = basic_hardware.Motor(self.arduino, "left")
         self.right_wheel = basic_hardware.Motor(self.arduino, "right")
+        self.set_profiles(profiles if profiles is not None else basic_hardware.default_profiles())
+        
+        self.encoders = None
+        self.odometry = None
+        if encoders:
+            self.odometry = sensor_analysis.Odometry(
+                basic_hardware.Encoders.TICKS_PER_METER, 
+                basic_hardware.Encoders.WHEEL_BASE)
+            self.encoders = basic_hardware.Encoders(self.arduino)
+            self.encoders.listeners.append(self.odometry.update)
+            
+        self.rangefinders = basic_hardware.Rangefinders(self.arduino, sonar or [])
+        
+        # Used by `track`.
+        self.steering = PID(1.2, 0.1, 0.15)
+        self.approach = PID(0.8, 0.05, 0.0, limits=(0.0, 1.0))
+        self.max_change = 3.0
+        self.reset_tracking()
+        
+    def set_profiles(self, profiles):
+        '''Makes both motors use the given profiles, matched so that they 
+        turn at the same speed.'''
+        top_speed = min(profile.max_speed for profile in profiles.values())
+        for wheel in (self.left_wheel, self.right_wheel):
+            profiles[wheel.side].match(top_speed)
+            wheel.profile = profiles[wheel.side]
+        return self
         
     def set_speed(self, left, right):
         self.left_wheel.set_speed(left)
-        self.right_wheel.set_speed(right*0.5)
+        self.right_wheel.set_speed(right)
         return self
         
     def set_forward_speed(self, speed=1):
@@ -91,7 +218,11 @@ class Robot(object):
         return self
         
     def set_left_speed(self, speed=1):
-        self.set_speed(-speed, 0.8*speed)
+        # When spinning left, the right wheel turns at 0.8 of the left 
+        # wheel's speed, which is how fast `WaitingState` expects to turn.
+        # (The differences between the motors themselves are handled by 
+        # their profiles.)
+        self.set_speed(-speed, 0.8 * speed)
         return self
         
     def set_right_speed(self, speed=1):
@@ -103,7 +234,86 @@ class Robot(object):
         return self
         
     def stop(self):
-        self.zero_speed()
+        '''Stops both wheels straight away.'''
+        self.left_wheel.stop()
+        self.right_wheel.stop()
+        
+    def is_moving(self):
+        '''Returns True if either wheel is turning (or about to).'''
+        return any(wheel.speed != 0 or wheel.target != 0 
+            for wheel in (self.left_wheel, self.right_wheel))
+            
+    def is_moving_forward(self):
+        '''Returns True if the robot is driving (or about to drive) 
+        forwards, rather than backing up or turning on the spot.'''
+        return sum(wheel.target for wheel in (self.left_wheel, self.right_wheel)) > 0
+        
+    def obstacle_distance(self):
+        '''Returns how far away (in meters) the closest thing in front of 
+        the rangefinders is, or None if nothing is in range. This doesn't 
+        wait for the Arduino, so it can be called every tick.'''
+        return sensor_analysis.nearest_obstacle(self.rangefinders.read())
+        
+    def sonar_blind(self):
+        '''Returns True if any of the rangefinders had gone silent as of the
+        last `obstacle_distance`, so we can't tell what's in front of 
+        them (see `basic_hardware.Rangefinders`).'''
+        return len(self.rangefinders.silent) > 0
+            
+    def update(self):
+        '''Gets each wheel closer to the speed it was set to. This should be
+        called every tick (see `basic_hardware.Motor`).'''
+        self.left_wheel.update()
+        self.right_wheel.update()
+        return self
+        
+    def track(self, x_error, range_error=None, now=None):
+        '''
+        Steers towards something, and should be called once every tick.
+        
+        `x_error` is how far off to the side the thing is, from -1 (at the 
+        left edge of the camera image) to 1 (at the right edge). 
+        `range_error` is how much further away (in meters) it is than where
+        we want to stop, or None if we don't know.
+        
+        Instead of jumping between full speed forward and spinning in place,
+        this works out how fast each wheel should go using the `steering` and
+        `approach` PID controllers, so the robot curves smoothly towards its
+        target and slows down as it gets close. The wheel speeds can change
+        by at most `max_change` a second, which stops the robot from 
+        jerking (or flipping direction) when the target jumps around.
+        '''
+        if now is None:
+            now = time.time()
+        turn = self.steering.update(x_error, now)
+        if range_error is None:
+            forward = 1.0
+        else:
+            forward = self.approach.update(range_error, now)
+        # Don't drive forward much until we're pointing the right way.
+        forward *= max(0.0, 1.0 - 2.0 * abs(x_error))
+        
+        left = forward + turn
+        right = forward - turn
+        biggest = max(1.0, abs(left), abs(right))
+        left, right = left / biggest, right / biggest
+        
+        # The first time around, start from a standstill.
+        step = 0.0 if self.last_track is None else self.max_change * (now - self.last_track)
+        left = max(self.track_speeds[0] - step, min(self.track_speeds[0] + step, left))
+        right = max(self.track_speeds[1] - step, min(self.track_speeds[1] + step, right))
+        self.track_speeds = (left, right)
+        self.last_track = now
+        self.set_speed(left, right)
+        return self
+        
+    def reset_tracking(self):
+        '''Forgets everything `track` has learned, so it starts fresh next
+        time it's called.'''
+        self.steering.reset()
+        self.approach.reset()
+        self.track_speeds = (0.0, 0.0)
+        self.last_track = None
     
     def set_laptop_tilt(self, position):
         if 50 <= position < 180:
@@ -155,3 +365,95 @@ class Robot(object):
                 time.sleep(0.5/180.0) # takes 0.5 extra sec to travel 180 degrees 
                 current += delta
                 self.laptop_servo.set_angle(current)
+
+
+class Watchdog(object):
+    '''
+    Stops the robot if the program stops paying attention to it.
+    
+    The motors keep going at whatever speed they were last given, so if 
+    the main loop gets stuck (waiting on the serial cable, or on a slow 
+    camera frame), or the dashboard's browser disconnects halfway 
+    through driving it by hand, the robot would carry on blindly. 
+    
+    The main loop calls `heartbeat` every tick. A background thread 
+    checks on it every so often, and if there hasn't been a heartbeat for
+    `timeout` seconds, it stops the robot (once, until the heartbeats come
+    back). 
+    
+    Commands from the dashboard go stale too: the dashboard keeps sending
+    the joystick position while it's held, so the main loop calls 
+    `command` whenever one arrives, and stops obeying them once 
+    `commands_fresh` returns False.
+    
+    As a last resort (if the whole program dies, say), the Arduino is 
+    also told to stop the motors by itself if it doesn't hear from us for
+    `board_timeout` seconds (see `Arduino.setWatchdog`). While the robot
+    is moving, `heartbeat` reminds the Arduino that we're still here.
+    '''
+    def __init__(self, robot, timeout=0.5, command_timeout=0.5, board_timeout=1.0):
+        self.robot = robot
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.board_timeout = board_timeout
+        
+        self.last_heartbeat = time.time()
+        self.last_command = None
+        self.last_reminder = None
+        self.tripped = False
+        self.trips = 0
+        
+        if board_timeout is not None:
+            self.robot.arduino.setWatchdog(int(board_timeout * 1000))
+            self.last_reminder = time.time()
+        
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._watch_loop, name='watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def heartbeat(self, now=None):
+        '''Tells the watchdog the main loop is still running.'''
+        if now is None:
+            now = time.time()
+        self.last_heartbeat = now
+        self.tripped = False
+        if (self.board_timeout is not None and self.robot.is_moving() and 
+                now - self.last_reminder > self.board_timeout / 3):
+            self.robot.arduino.setWatchdog(int(self.board_timeout * 1000))
+            self.last_reminder = now
+            
+    def command(self, now=None):
+        '''Tells the watchdog a command just arrived from the dashboard.'''
+        self.last_command = time.time() if now is None else now
+        
+    def commands_fresh(self, now=None):
+        '''Returns True if a command arrived from the dashboard within the 
+        last `command_timeout` seconds.'''
+        if now is None:
+            now = time.time()
+        return self.last_command is not None and now - self.last_command <= self.command_timeout
+        
+    def check(self, now=None):
+        '''Stops the robot if the heartbeats have stopped. Returns True if 
+        it did.'''
+        if now is None:
+            now = time.time()
+        if self.tripped or now - self.last_heartbeat <= self.timeout:
+            return False
+        self.tripped = True
+        self.trips += 1
+        self.robot.zero_speed()
+        self.robot.stop()
+        return True
+        
+    def _watch_loop(self):
+        while not self._stopping.wait(self.timeout / 4):
+            self.check()
+            
+    def close(self):
+        '''Stops watching, and tells the Arduino to stop watching too.'''
+        self._stopping.set()
+        self._thread.join(2)
+        if self.board_timeout is not None:
+            self.robot.arduino.setWatchdog(0)
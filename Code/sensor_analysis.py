@@ -55,8 +55,11 @@ You may want to first read the [Python documentation][mc] on the
     sensor data.
 *   This layer uses a 3rd party library called [SimpleCV][sc]
     for vision processing.
+*   This layer uses [NumPy][np] (which SimpleCV also needs) to crunch 
+    numbers about the detected features.
 
   [sc]: http://www.simplecv.org/
+  [np]: http://www.numpy.org/
   
 
 ## Up next
@@ -66,12 +69,82 @@ After reading this file, read `robot_actions.py`.
 
 from __future__ import division
 
+import json
+import math
 import multiprocessing
 import Queue
+import threading
 import time
 
+import numpy as np
 import SimpleCV as scv
 
+# The full list of features SimpleCV ships cascades for. We should stick 
+# to either `face`, `profile`, `upper_body`, or `lower_body`.
+VALID_FEATURES = [
+    'eye', 
+    'face', 
+    'face2', 
+    'face3', 
+    'face4', 
+    'fullbody', 
+    'glasses', 
+    'lefteye', 
+    'left_ear', 
+    'left_eye2', 
+    'lower_body',
+    'mouth', 
+    'nose', 
+    'profile', 
+    'right_ear', 
+    'right_eye', 
+    'right_eye2', 
+    'two_eyes_big', 
+    'two_eyes_small', 
+    'upper_body', 
+    'upper_body2']
+
+
+class CascadeRegistry(object):
+    '''
+    Loads and keeps hold of the Haar cascades used to find features.
+    
+    Each cascade is an xml file describing what a feature statistically 
+    looks like (see step 3 in `get_human_locations`). Passing the name of 
+    the file to `findHaarFeatures` makes SimpleCV find and parse the file 
+    every time, which is slow. Instead, the registry parses each cascade 
+    once and hands out the same parsed object every time after that.
+    
+    Each process has to have its own registry, since parsed cascades can't
+    be passed between processes. `preload` can be used to load all the 
+    cascades a process will need before it starts analyzing frames, so 
+    switching between them later costs nothing.
+    '''
+    def __init__(self):
+        self.cascades = {}
+        
+    def get(self, name):
+        '''Returns the parsed cascade for the feature called `name`.'''
+        cascade = self.cascades.get(name)
+        if cascade is None:
+            if name not in VALID_FEATURES:
+                raise ValueError('{0} is not a valid feature'.format(name))
+            cascade = scv.HaarCascade(name + '.xml')
+            if cascade.getCascade() is None:
+                raise ValueError('Could not load the cascade for {0}'.format(name))
+            self.cascades[name] = cascade
+        return cascade
+        
+    def preload(self, names):
+        '''Loads every cascade in `names`.'''
+        for name in names:
+            self.get(name)
+        return self
+
+# The registry used by `get_human_locations`.
+CASCADES = CascadeRegistry()
+
+
 def get_human_locations(image, quality = 0.25, target_feature="upper_body"):
     '''
     Gets the location of humans detected in the provided SimpleCV image. 
@@ -90,8 +163,10 @@ def get_human_locations(image, quality = 0.25, target_feature="upper_body"):
         is used to scale the image to change the resolution.
     -   target_feature:  
         The part of the human body to look for. The full list of valid 
-        "features" can be found below, but we should stick to either
-        `face`, `upper_body`, or `lower_body`. 
+        "features" can be found in `VALID_FEATURES`, but we should stick 
+        to either `face`, `upper_body`, or `lower_body`. This can also be 
+        a list of features, in which case all of them are searched for
+        and overlapping results are merged (see `non_max_suppression`).
         
     Returns:
     
@@ -106,12 +181,16 @@ def get_human_locations(image, quality = 0.25, target_feature="upper_body"):
     -   top_left_y
     -   center_x
     -   center_y
+    -   feature
     -   full_feature
     
     The height, width, top left coordinates, and center coordinates are 
     the pixel coordinates of the detected feature respective to the top
     left corner of the original image. 
     
+    The `feature` item is the name of the feature that was detected (for 
+    example, `face`).
+    
     The `full_feature` item contains the original `Features` object 
     produced by SimpleCV, which contains all the additional data which 
     is not normally returned.
@@ -126,7 +205,8 @@ def get_human_locations(image, quality = 0.25, target_feature="upper_body"):
             analyzing a large quantity of features. For example, if you wanted to find
             only faces, you would use `face.xml`, which contains information about what
             the average face statistically looks like, based on the training data. Each
-            face found is considered a "feature".
+            face found is considered a "feature". The parsed file is kept in `CASCADES`,
+            so it only has to be loaded once.
         4.  Using the statistical model provided within the xml file, analyze the image
             to find all the features present within the image.
         5.  Parse the output. If there are no features, return an empty list. Otherwise,
@@ -135,51 +215,769 @@ def get_human_locations(image, quality = 0.25, target_feature="upper_body"):
             originally scaled down. This ensures that all the coordinates returned are 
             correct respective to the original image.
     '''
-    valid_features = [
-        'eye', 
-        'face', 
-        'face2', 
-        'face3', 
-        'face4', 
-        'fullbody', 
-        'glasses', 
-        'lefteye', 
-        'left_ear', 
-        'left_eye2', 
-        'lower_body',
-        'mouth', 
-        'nose', 
-        'profile', 
-        'right_ear', 
-        'right_eye', 
-        'right_eye2', 
-        'two_eyes_big', 
-        'two_eyes_small', 
-        'upper_body', 
-        'upper_body2']
     assert(0 < quality <= 1)
-    assert(target_feature in valid_features)
+    if isinstance(target_feature, basestring):
+        target_feature = [target_feature]
+    cascades = [(name, CASCADES.get(name)) for name in target_feature]
+    return _find_features(image, cascades, quality, keep_full_feature=True)
     
-    features = image.scale(quality).findHaarFeatures(target_feature + ".xml")
-    if features is None:
-        return []
-    else:
-        output = []
+def _find_features(image, cascades, quality, keep_full_feature=False):
+    '''
+    Runs every cascade in `cascades` (a list of (name, cascade) pairs) over 
+    the image, and returns the features found. This does steps 2 to 6 of 
+    `get_human_locations`.
+    
+    The image is only scaled once, no matter how many cascades there are.
+    SimpleCV also remembers the grayscale, equalized version of an image the
+    first time a cascade is run on it, so the other cascades get that for
+    free too.
+    '''
+    scaled = image.scale(quality)
+    scale = round(1 / quality)
+    output = []
+    for name, cascade in cascades:
+        features = scaled.findHaarFeatures(cascade)
+        if features is None:
+            continue
         for feature in features:
-            scale = round(1 / quality)
             x, y = feature.topLeftCorner()
-            output.append({
+            found = {
                 'height': feature.height() * scale,
                 'width': feature.width() * scale,
                 'top_left_x': x * scale,
                 'top_right_x': y * scale,
                 'center_x': feature.x * scale,
                 'center_y': feature.y * scale,
-                'full_feature': feature
-            })
-        return output
+                'feature': name,
+            }
+            if keep_full_feature:
+                found['full_feature'] = feature
+            output.append(found)
+    if len(cascades) > 1:
+        output = non_max_suppression(output)
+    return output
+    
+class DetectionView(object):
+    '''
+    A single row of a `Detections` object, which behaves like the read-only 
+    dicts returned by `get_human_locations`. It doesn't copy anything; it 
+    just looks up values in the array when asked for them.
+    '''
+    __slots__ = ('row',)
+    
+    def __init__(self, row):
+        self.row = row
+        
+    def __getitem__(self, key):
+        value = self.row[Detections.INDEX[key]]
+        if key == 'feature':
+            return VALID_FEATURES[int(value)] if value >= 0 else None
+        if key == 'id':
+            return int(value)
+        if key == 'range' and np.isnan(value):
+            return None
+        return float(value)
+        
+    def get(self, key, default=None):
+        if key not in Detections.INDEX:
+            return default
+        return self[key]
+        
+    def keys(self):
+        return list(Detections.COLUMNS)
+        
+    def items(self):
+        return [(key, self[key]) for key in Detections.COLUMNS]
+        
+    def __contains__(self, key):
+        return key in Detections.INDEX
+        
+    def __iter__(self):
+        return iter(Detections.COLUMNS)
+        
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class Detections(object):
+    '''
+    A group of detected features, stored as a NumPy array with one row per 
+    feature and one column per item in `COLUMNS`. The `feature` column 
+    holds the position of the feature's name in `VALID_FEATURES` (or -1 if 
+    it's unknown). The `id`, `velocity_x`, `velocity_y` and `confidence` 
+    columns are filled in by `Tracker`, and the `range` column (how far 
+    away each person is, in meters) is filled in by `CameraCalibration`.
+    Until then, they're set to the values in `DEFAULTS`. An unknown range
+    is NaN (or None, when read through a `DetectionView`).
+    
+    Doing math on a whole array at once with NumPy is a lot faster than 
+    looping over a list of dicts in Python, and an array is a lot smaller
+    to send between processes. 
+    
+    For code that expects a list of dicts, a `Detections` object can be 
+    looped over, indexed and passed to `len` just like a list. Each item is 
+    a `DetectionView`, which behaves like a dict.
+    '''
+    COLUMNS = [
+        'top_left_x', 'top_right_x', 'width', 'height', 'center_x', 'center_y', 
+        'feature', 'id', 'velocity_x', 'velocity_y', 'confidence', 'range']
+    INDEX = {name: index for (index, name) in enumerate(COLUMNS)}
+    DEFAULTS = {
+        'feature': -1, 'id': -1, 'velocity_x': 0, 'velocity_y': 0, 'confidence': 1, 
+        'range': float('nan')}
+    
+    def __init__(self, array=None):
+        if array is None:
+            array = np.zeros((0, len(Detections.COLUMNS)), dtype=np.float32)
+        self.array = array
+        
+    @classmethod
+    def from_rects(cls, rects, scale, feature):
+        '''
+        Creates detections from a sequence of (x, y, width, height) 
+        rectangles, scaled up by `scale`, all found by the cascade for 
+        `feature`. `scale` is either a single number, or an (x scale, 
+        y scale) pair.
+        '''
+        scale_x, scale_y = scale if isinstance(scale, (tuple, list)) else (scale, scale)
+        rects = np.asarray(rects, dtype=np.float32).reshape(-1, 4) * np.array(
+            [scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        array = np.empty((len(rects), len(Detections.COLUMNS)), dtype=np.float32)
+        for name, value in Detections.DEFAULTS.items():
+            array[:, Detections.INDEX[name]] = value
+        array[:, 0:4] = rects
+        array[:, 4] = rects[:, 0] + rects[:, 2] / 2
+        array[:, 5] = rects[:, 1] + rects[:, 3] / 2
+        if feature in VALID_FEATURES:
+            array[:, 6] = VALID_FEATURES.index(feature)
+        return cls(array)
+        
+    @classmethod
+    def from_dicts(cls, features):
+        '''Creates detections from a list of dicts like the ones returned 
+        by `get_human_locations`.'''
+        array = np.empty((len(features), len(Detections.COLUMNS)), dtype=np.float32)
+        for index, feature in enumerate(features):
+            for column, name in enumerate(Detections.COLUMNS):
+                value = feature.get(name)
+                if name != 'feature':
+                    array[index, column] = value if value is not None else Detections.DEFAULTS.get(name, 0)
+            name = feature.get('feature')
+            array[index, 6] = VALID_FEATURES.index(name) if name in VALID_FEATURES else -1
+        return cls(array)
+        
+    @classmethod
+    def concatenate(cls, parts):
+        if len(parts) == 0:
+            return cls()
+        return cls(np.concatenate([part.array for part in parts]))
+        
+    def column(self, name):
+        return self.array[:, Detections.INDEX[name]]
+        
+    def select(self, indices):
+        '''Returns the detections at `indices` (or where `indices` is True).'''
+        return Detections(self.array[indices])
+        
+    def __len__(self):
+        return len(self.array)
+        
+    def __iter__(self):
+        for row in self.array:
+            yield DetectionView(row)
+            
+    def __getitem__(self, index):
+        return DetectionView(self.array[index])
+        
+    def __repr__(self):
+        return 'Detections({0!r})'.format(self.to_list())
+        
+    def to_list(self):
+        '''Returns the detections as a list of plain dicts.'''
+        return [dict(view.items()) for view in self]
+        
+    def areas(self):
+        return self.column('width') * self.column('height')
+        
+    def centroid(self):
+        '''The average center of every detection, or (0, 0) if there are
+        none. See `get_centroid`.'''
+        if len(self) == 0:
+            return (0, 0)
+        return (
+            int(round(self.column('center_x').mean())), 
+            int(round(self.column('center_y').mean())))
+            
+    def filter_size(self, min_height=0, max_height=float('inf')):
+        '''Returns only the detections between `min_height` and `max_height`
+        pixels tall.'''
+        heights = self.column('height')
+        return self.select((heights >= min_height) & (heights <= max_height))
+        
+    def largest(self):
+        '''Returns the detection with the biggest area, or None if there 
+        are none.'''
+        if len(self) == 0:
+            return None
+        return self[int(np.argmax(self.areas()))]
         
-def _get_features(features_queue, images_queue, message_queue, size, quality, target_feature):
+    def stats(self):
+        '''Returns a few numbers summarizing the detections.'''
+        if len(self) == 0:
+            return {'count': 0, 'max_height': 0, 'max_width': 0, 'mean_height': 0, 
+                'min_range': float('nan')}
+        ranges = self.column('range')
+        known = ranges[~np.isnan(ranges)]
+        return {
+            'count': len(self),
+            'max_height': float(self.column('height').max()),
+            'max_width': float(self.column('width').max()),
+            'mean_height': float(self.column('height').mean()),
+            'min_range': float(known.min()) if len(known) > 0 else float('nan'),
+        }
+        
+    def non_max_suppression(self, threshold=0.5):
+        '''
+        Merges detections that are most likely the same person. Going from 
+        the biggest detection to the smallest, each one is kept only if it 
+        doesn't overlap any of the ones kept so far by more than `threshold`.
+        
+        The overlap is measured as a fraction of the area of the smaller 
+        detection, rather than of the combined area, so that a face found 
+        inside an upper body counts as the same person.
+        '''
+        if len(self) < 2:
+            return self
+        left = self.column('top_left_x')
+        top = self.column('top_right_x')
+        right = left + self.column('width')
+        bottom = top + self.column('height')
+        areas = self.areas()
+        
+        order = np.argsort(-areas, kind='mergesort')
+        keep = []
+        while len(order) > 0:
+            biggest = order[0]
+            keep.append(biggest)
+            rest = order[1:]
+            width = np.minimum(right[biggest], right[rest]) - np.maximum(left[biggest], left[rest])
+            height = np.minimum(bottom[biggest], bottom[rest]) - np.maximum(top[biggest], top[rest])
+            intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+            smallest = np.maximum(np.minimum(areas[biggest], areas[rest]), 1e-6)
+            order = rest[intersection / smallest <= threshold]
+        return self.select(np.array(keep))
+        
+
+def as_detections(features):
+    '''Converts a list of feature dicts to `Detections`, if it isn't already.'''
+    if isinstance(features, Detections):
+        return features
+    return Detections.from_dicts(features)
+    
+def non_max_suppression(features, threshold=0.5):
+    '''
+    Merges features that are most likely the same person (see 
+    `Detections.non_max_suppression`). Works on both `Detections` and 
+    lists of dicts, and returns the same kind of thing it was given.
+    '''
+    if isinstance(features, Detections):
+        return features.non_max_suppression(threshold)
+    detections = Detections.from_dicts(features)
+    detections.array[:, Detections.INDEX['id']] = np.arange(len(features))
+    kept = detections.non_max_suppression(threshold).column('id')
+    return [features[int(index)] for index in kept]
+        
+def iou_matrix(a, b):
+    '''
+    Returns a `len(a)` by `len(b)` array containing the 
+    [intersection over union][iou] of every pair of detections in `a` 
+    and `b`.
+    
+      [iou]: http://en.wikipedia.org/wiki/Jaccard_index
+    '''
+    a_left = a.column('top_left_x')[:, np.newaxis]
+    a_top = a.column('top_right_x')[:, np.newaxis]
+    a_right = a_left + a.column('width')[:, np.newaxis]
+    a_bottom = a_top + a.column('height')[:, np.newaxis]
+    b_left = b.column('top_left_x')[np.newaxis, :]
+    b_top = b.column('top_right_x')[np.newaxis, :]
+    b_right = b_left + b.column('width')[np.newaxis, :]
+    b_bottom = b_top + b.column('height')[np.newaxis, :]
+    
+    width = np.clip(np.minimum(a_right, b_right) - np.maximum(a_left, b_left), 0, None)
+    height = np.clip(np.minimum(a_bottom, b_bottom) - np.maximum(a_top, b_top), 0, None)
+    intersection = width * height
+    union = a.areas()[:, np.newaxis] + b.areas()[np.newaxis, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+    
+def greedy_assignment(scores, threshold, rows=None, columns=None):
+    '''
+    Pairs up rows and columns of `scores`, best score first, so that every 
+    row and column is used at most once and no pair scores below 
+    `threshold`. Only the rows and columns listed in `rows` and `columns` 
+    are considered (all of them, by default). Returns a list of (row, 
+    column) pairs.
+    
+    This isn't guaranteed to find the best possible pairing (the 
+    [Hungarian algorithm][ha] does that), but with only a handful of 
+    people in view, it almost always finds the same answer, much faster.
+    
+      [ha]: http://en.wikipedia.org/wiki/Hungarian_algorithm
+    '''
+    rows = np.arange(scores.shape[0]) if rows is None else np.asarray(rows, dtype=int)
+    columns = np.arange(scores.shape[1]) if columns is None else np.asarray(columns, dtype=int)
+    if len(rows) == 0 or len(columns) == 0:
+        return []
+    candidates = scores[np.ix_(rows, columns)]
+    order = np.argsort(-candidates, axis=None, kind='mergesort')
+    order = order[candidates.ravel()[order] >= threshold]
+    
+    pairs = []
+    used_rows = set()
+    used_columns = set()
+    for row, column in zip(*np.unravel_index(order, candidates.shape)):
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        pairs.append((int(rows[row]), int(columns[column])))
+    return pairs
+
+
+class Tracker(object):
+    '''
+    Gives every detected person an ID that stays the same from frame to 
+    frame, so that the robot can pick one person and keep following them
+    instead of driving towards the average of everybody in view.
+    
+    Each new set of detections is matched against the people already 
+    being tracked:
+    
+    1.  First by how much their boxes overlap (see `iou_matrix`).
+    2.  Then, for anybody left over (usually someone who moved quickly), 
+        by how close their centers are, compared to the size of the box.
+        
+    Detections that don't match anyone get a new ID.
+    
+    
+    ### Smoothing ###
+    
+    The Haar cascades are pretty noisy. Boxes jump around by a few pixels
+    every frame, and people regularly vanish for a frame or two and come 
+    back. Acting on the raw detections makes the robot flicker between 
+    states and twitch its motors back and forth.
+    
+    To stop that, every track is smoothed with an [alpha-beta filter][ab],
+    which keeps track of where each person is and how fast they're moving.
+    Every time a new frame is analyzed, each track is moved forward by its 
+    velocity, and then nudged a fraction (`alpha`) of the way towards the
+    detection it matched. The velocity is nudged by `beta` of the 
+    difference. In between frames, `update` returns where each person 
+    should be by now.
+    
+    Tracks also need to be seen `min_hits` times before they're 
+    "confirmed" and returned by `update`, and are only forgotten after 
+    being missed `max_misses` frames in a row. Each track has a 
+    `confidence` between 0 and 1 that goes up every time it's seen and 
+    down every time it's missed.
+    
+    Tracks are only moved forward by at most `max_prediction` seconds' 
+    worth of velocity. Frames can stop being analyzed for a good while 
+    (see `MotionGate`), and a guess at where someone walked off to seconds
+    ago would only lead the robot off the edge of the screen.
+    
+      [ab]: http://en.wikipedia.org/wiki/Alpha_beta_filter
+    '''
+    STRATEGIES = {
+        # The biggest box on screen.
+        'largest': lambda tracks: tracks.areas(),
+        # The tallest box, since people closer to the camera look taller.
+        'nearest': lambda tracks: tracks.column('height'),
+    }
+    
+    def __init__(self, iou_threshold=0.3, max_distance=1.0, min_hits=3, max_misses=5, 
+            alpha=0.5, beta=0.1, confidence_gain=0.3, max_prediction=0.5):
+        '''
+        Arguments:
+        
+        -   iou_threshold:
+            The least overlap between a detection and a track for them to
+            count as the same person.
+        -   max_distance:
+            How far apart (as a multiple of the track's width) the centers
+            of a detection and a track can be for them to count as the 
+            same person, if they don't overlap enough.
+        -   min_hits:
+            How many times someone has to be seen before they're confirmed.
+        -   max_misses:
+            How many frames in a row someone can be missed before they're
+            forgotten.
+        -   alpha, beta:
+            How much to trust new detections over the filter's estimate of
+            each person's position and velocity. Both go from 0 to 1.
+        -   confidence_gain:
+            How quickly the confidence changes when someone is seen or 
+            missed.
+        -   max_prediction:
+            The most time (in seconds) to move tracks forward by.
+        '''
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.alpha = alpha
+        self.beta = beta
+        self.confidence_gain = confidence_gain
+        self.max_prediction = max_prediction
+        
+        # Every track, as of `last_update`.
+        self.tracks = Detections()
+        self.hits = np.zeros(0, dtype=int)
+        self.misses = np.zeros(0, dtype=int)
+        self.confirmed = np.zeros(0, dtype=bool)
+        self.last_update = None
+        
+        # The confirmed tracks, as last returned by `update`.
+        self.output = Detections()
+        self.next_id = 0
+        self.sequence = None
+        self.target_id = None
+        
+    def _elapsed(self, now):
+        '''Returns how long it's been since `last_update`, up to 
+        `max_prediction`.'''
+        if self.last_update is None:
+            return 0
+        return min(max(0, now - self.last_update), self.max_prediction)
+        
+    def predict(self, now):
+        '''Returns a copy of every track, moved to where it should be at
+        `now`.'''
+        predicted = Detections(self.tracks.array.copy())
+        if self.last_update is not None and len(predicted) > 0:
+            dt = self._elapsed(now)
+            predicted.column('center_x')[:] += predicted.column('velocity_x') * dt
+            predicted.column('center_y')[:] += predicted.column('velocity_y') * dt
+            _update_corners(predicted)
+        return predicted
+        
+    def associate(self, tracks, detections):
+        '''Returns a list of (track index, detection index) pairs for 
+        the detections that match a track.'''
+        if len(tracks) == 0 or len(detections) == 0:
+            return []
+        pairs = greedy_assignment(iou_matrix(tracks, detections), self.iou_threshold)
+        
+        rows = np.setdiff1d(np.arange(len(tracks)), [row for (row, column) in pairs])
+        columns = np.setdiff1d(np.arange(len(detections)), [column for (row, column) in pairs])
+        if len(rows) > 0 and len(columns) > 0:
+            dx = tracks.column('center_x')[:, np.newaxis] - detections.column('center_x')[np.newaxis, :]
+            dy = tracks.column('center_y')[:, np.newaxis] - detections.column('center_y')[np.newaxis, :]
+            limit = self.max_distance * np.maximum(tracks.column('width'), 1)[:, np.newaxis]
+            closeness = 1 - np.hypot(dx, dy) / limit
+            pairs.extend(greedy_assignment(closeness, 0, rows, columns))
+        return pairs
+        
+    def update(self, detections, sequence=None, now=None):
+        '''
+        Matches a new set of detections against the tracked people, and 
+        returns every confirmed person as `Detections` with the smoothed
+        position and the `id`, `velocity_x`, `velocity_y` and `confidence`
+        columns filled in.
+        
+        If `sequence` is given and is the same as last time (see 
+        `ImageProvider.sequence`), the detections are ones that have 
+        already been seen, so the tracks are just moved forward in time.
+        '''
+        if now is None:
+            now = time.time()
+        if sequence is not None and sequence == self.sequence:
+            predicted = self.predict(now)
+            self.output = predicted.select(self.confirmed)
+            return self.output
+        self.sequence = sequence
+        
+        dt = self._elapsed(now)
+        tracks = self.predict(now)
+        self.last_update = now
+        
+        detections = Detections(as_detections(detections).array.copy())
+        pairs = self.associate(tracks, detections)
+        rows = np.array([row for (row, column) in pairs], dtype=int)
+        columns = np.array([column for (row, column) in pairs], dtype=int)
+        
+        # Nudge the matched tracks towards their detections.
+        if len(pairs) > 0:
+            index = Detections.INDEX
+            position = [index['center_x'], index['center_y']]
+            velocity = [index['velocity_x'], index['velocity_y']]
+            size = [index['width'], index['height']]
+            old = tracks.array[rows]
+            new = detections.array[columns]
+            residual = new[:, position] - old[:, position]
+            old[:, position] += self.alpha * residual
+            if dt > 0:
+                old[:, velocity] += self.beta * residual / dt
+            old[:, size] += self.alpha * (new[:, size] - old[:, size])
+            old[:, index['feature']] = new[:, index['feature']]
+            old[:, index['confidence']] += self.confidence_gain * (1 - old[:, index['confidence']])
+            tracks.array[rows] = old
+            
+        matched = np.zeros(len(tracks), dtype=bool)
+        matched[rows] = True
+        self.hits[matched] += 1
+        self.misses[matched] = 0
+        self.misses[~matched] += 1
+        tracks.column('confidence')[~matched] *= 1 - self.confidence_gain
+        
+        # Anyone who didn't match a track is somebody new.
+        unmatched = np.ones(len(detections), dtype=bool)
+        unmatched[columns] = False
+        new = detections.select(unmatched)
+        new.column('id')[:] = np.arange(self.next_id, self.next_id + len(new))
+        new.column('velocity_x')[:] = 0
+        new.column('velocity_y')[:] = 0
+        new.column('confidence')[:] = self.confidence_gain
+        self.next_id += len(new)
+        
+        kept = self.misses <= self.max_misses
+        self.tracks = Detections.concatenate([tracks.select(kept), new])
+        _update_corners(self.tracks)
+        self.hits = np.concatenate([self.hits[kept], np.ones(len(new), dtype=int)])
+        self.misses = np.concatenate([self.misses[kept], np.zeros(len(new), dtype=int)])
+        self.confirmed = np.concatenate([self.confirmed[kept], np.zeros(len(new), dtype=bool)])
+        self.confirmed |= self.hits >= self.min_hits
+        
+        self.output = self.tracks.select(self.confirmed)
+        return self.output
+        
+    def lock(self, strategy='largest'):
+        '''
+        Returns the confirmed person the robot should follow, or None if 
+        nobody is being tracked. Once someone is picked (using one of the 
+        `STRATEGIES`), the same person is returned until they're lost.
+        '''
+        tracks = self.output
+        if len(tracks) == 0:
+            self.target_id = None
+            return None
+        ids = tracks.column('id')
+        if self.target_id is not None:
+            found = np.flatnonzero(ids == self.target_id)
+            if len(found) > 0:
+                return tracks[int(found[0])]
+        index = int(np.argmax(Tracker.STRATEGIES[strategy](tracks)))
+        self.target_id = int(ids[index])
+        return tracks[index]
+        
+    def unlock(self):
+        '''Forgets the current target, so that a new one is picked.'''
+        self.target_id = None
+        
+def _update_corners(detections):
+    '''Recalculates the top-left corner of each detection from its center
+    and size.'''
+    detections.column('top_left_x')[:] = detections.column('center_x') - detections.column('width') / 2
+    detections.column('top_right_x')[:] = detections.column('center_y') - detections.column('height') / 2
+        
+
+def preprocess(image, quality):
+    '''
+    Gets an image ready to be analyzed by the worker in `ImageProvider`.
+    
+    The Haar cascades only look at a shrunk-down, grayscale version of 
+    the image, so we shrink it and convert it to grayscale right away, 
+    and only send that to the worker. This is a third of the size of the
+    color image even at full quality, and a lot less at lower qualities.
+    
+    Returns the raw grayscale bytes (one per pixel), and their size as 
+    (width, height). The width is rounded down to a multiple of 4, since
+    OpenCV pads every row of an image to a multiple of 4 bytes, so the 
+    image is shrunk by slightly different amounts across and down (see 
+    `ImageProvider.start`).
+    '''
+    width, height = image.size()
+    size = (max(4, int(width * quality) // 4 * 4), max(1, int(height * quality)))
+    small = scv.cv.CreateImage(size, scv.cv.IPL_DEPTH_8U, 3)
+    scv.cv.Resize(image.getBitmap(), small)
+    gray = scv.cv.CreateImage(size, scv.cv.IPL_DEPTH_8U, 1)
+    scv.cv.CvtColor(small, gray, scv.cv.CV_BGR2GRAY)
+    return gray.tostring(), size
+    
+class CameraCalibration(object):
+    '''
+    Works out how far away people are from how big they look.
+    
+    Something `known_height` meters tall and `distance` meters away from 
+    a camera shows up as roughly 
+    
+        pixel_height = focal_length * known_height / distance
+        
+    pixels tall, where `focal_length` (in pixels) depends on the camera's
+    lens and resolution. Since we know roughly how big faces and bodies 
+    are, we can turn that around and get the distance from the height of 
+    each box.
+    
+    Every camera is a bit different, so the focal length (measured at 
+    `image_width` pixels wide) and the size of each feature are stored in 
+    a JSON file per camera. The easiest way to make one is to stand a 
+    known distance from the camera, note how tall the detected box is, 
+    and pass both to `calibrate`.
+    
+    Rather than dividing for every detection, `measure` looks the range 
+    up in a table with one entry per feature and box height, which is 
+    built once for each image width.
+    '''
+    # How tall (in meters) the box each cascade draws around a typical 
+    # person is.
+    FEATURE_HEIGHTS = {
+        'face': 0.22,
+        'face2': 0.22,
+        'face3': 0.22,
+        'face4': 0.22,
+        'profile': 0.22,
+        'upper_body': 0.6,
+        'upper_body2': 0.6,
+        'lower_body': 0.9,
+        'fullbody': 1.7,
+    }
+    
+    def __init__(self, focal_length=550, image_width=640, feature_heights=None, max_height=2048):
+        self.focal_length = focal_length
+        self.image_width = image_width
+        self.feature_heights = dict(CameraCalibration.FEATURE_HEIGHTS)
+        self.feature_heights.update(feature_heights or {})
+        self.max_height = max_height
+        self._table = None
+        self._table_width = None
+        
+    @classmethod
+    def load(cls, path):
+        '''Loads a calibration saved by `save`.'''
+        with open(path) as calibration:
+            return cls(**json.load(calibration))
+            
+    def save(self, path):
+        with open(path, 'w') as calibration:
+            json.dump({
+                'focal_length': self.focal_length,
+                'image_width': self.image_width,
+                'feature_heights': self.feature_heights,
+            }, calibration, indent=4, sort_keys=True)
+            
+    def calibrate(self, feature, pixel_height, distance, image_width):
+        '''
+        Sets the focal length from a single measurement: a `feature` 
+        detected `pixel_height` pixels tall in an image `image_width` 
+        pixels wide, `distance` meters away.
+        '''
+        self.focal_length = pixel_height * distance / self.feature_heights[feature]
+        self.image_width = image_width
+        self._table = None
+        
+    def table(self, image_width):
+        '''
+        Returns the lookup table for images `image_width` pixels wide. 
+        Row `n` holds the range for each box height of `VALID_FEATURES[n]`,
+        and the last row (for unknown features) is all NaN.
+        '''
+        if self._table is None or self._table_width != image_width:
+            focal_length = self.focal_length * image_width / self.image_width
+            known = np.array(
+                [self.feature_heights.get(name, np.nan) for name in VALID_FEATURES] + [np.nan], 
+                dtype=np.float32)
+            heights = np.arange(self.max_height + 1, dtype=np.float32)
+            heights[0] = np.nan
+            self._table = focal_length * known[:, np.newaxis] / heights[np.newaxis, :]
+            self._table_width = image_width
+        return self._table
+        
+    def measure(self, detections, image_width):
+        '''Fills in the `range` column of `detections` (which were found in 
+        an image `image_width` pixels wide), and returns them.'''
+        if len(detections) == 0:
+            return detections
+        table = self.table(image_width)
+        heights = np.clip(np.round(detections.column('height')), 0, self.max_height).astype(int)
+        # Unknown features (-1) land on the last row.
+        features = detections.column('feature').astype(int)
+        detections.column('range')[:] = table[features, heights]
+        return detections
+        
+
+class MotionGate(object):
+    '''
+    Decides whether a frame is worth running the Haar cascades on.
+    
+    The robot spends a lot of time sitting still (waiting for someone to
+    press a button, for example), looking at a scene that isn't changing.
+    Running the cascades on those frames just burns through the battery
+    to find the same people in the same places. 
+    
+    Comparing a tiny grayscale thumbnail of each frame against the last 
+    frame that was analyzed is hundreds of times cheaper. If fewer than 
+    `fraction` of the pixels have changed by more than `threshold` (out of 
+    255), the frame is skipped, and the last results are reused. A frame 
+    is always analyzed if it's been more than `max_skip` seconds since 
+    the last one, just in case something changed too slowly to notice.
+    '''
+    def __init__(self, threshold=16, fraction=0.02, width=80, max_skip=5):
+        self.threshold = threshold
+        self.fraction = fraction
+        self.width = width
+        self.max_skip = max_skip
+        self.reference = None
+        self.last = 0
+        
+    def thumbnail(self, image):
+        '''Returns a tiny grayscale copy of `image` as a NumPy array.'''
+        raw, (width, height) = preprocess(image, self.width / image.size()[0])
+        return np.frombuffer(raw, dtype=np.uint8).reshape(height, width).astype(np.int16)
+        
+    def changed(self, image, force=False):
+        '''
+        Returns True if `image` is different enough from the last image 
+        this returned True for (or if `force` is True), in which case 
+        `image` becomes the one to compare against next time.
+        '''
+        thumbnail = self.thumbnail(image)
+        if not force and self.reference is not None and \
+                self.reference.shape == thumbnail.shape and \
+                time.time() - self.last < self.max_skip:
+            moved = np.abs(thumbnail - self.reference) > self.threshold
+            if np.count_nonzero(moved) <= self.fraction * moved.size:
+                return False
+        self.reference = thumbnail
+        self.last = time.time()
+        return True
+        
+
+def _find_features_in_gray(raw, size, cascades, scale):
+    '''
+    Runs every cascade in `cascades` (a list of (name, cascade) pairs) over 
+    a grayscale image made by `preprocess`, and returns the features found 
+    as `Detections`, scaled up by `scale`. 
+    
+    This skips SimpleCV's `Image` class altogether (which would convert 
+    the image back to color, then back to grayscale again), and calls
+    OpenCV directly with the same settings SimpleCV uses.
+    '''
+    gray = scv.cv.CreateImageHeader(size, scv.cv.IPL_DEPTH_8U, 1)
+    scv.cv.SetData(gray, raw)
+    equalized = scv.cv.CreateImage(size, scv.cv.IPL_DEPTH_8U, 1)
+    scv.cv.EqualizeHist(gray, equalized)
+    
+    parts = []
+    for name, cascade in cascades:
+        storage = scv.cv.CreateMemStorage(0)
+        found = scv.cv.HaarDetectObjects(
+            equalized, cascade.getCascade(), storage, 
+            1.2, 2, scv.cv.CV_HAAR_DO_CANNY_PRUNING, (20, 20))
+        parts.append(Detections.from_rects([rect for (rect, neighbors) in found], scale, name))
+    return Detections.concatenate(parts).non_max_suppression()
+        
+def _get_features(features_queue, images_queue, message_queue, size, scale, target_features,
+        preload=()):
     '''
     This is part of the multi-threaded version of the algorithm described in 
     `find_human_features`.
@@ -196,55 +994,46 @@ def _get_features(features_queue, images_queue, message_queue, size, quality, ta
             or numbers. The `Image` object from SimpleCV is not a primative
             Python object. As a result, we pass a binary string function between
             this process and the original program to bypass this limitation.
+            The string contains the shrunk-down grayscale image made by 
+            `preprocess`, which is `size` big. The features found are scaled
+            up by `scale` (an (x scale, y scale) pair) to match the 
+            original image.
         2.  Data can only be passed in and out through `multiprocessing.Queue` objects.
         3.  This function does not validate the input.
         
-    If this function cannot find a feature, it returns either an empty list or None.
+    Every cascade in `preload` (and `target_features`) is loaded before the first
+    frame is analyzed. Sending `('target', names)` through `message_queue` switches
+    to looking for a different list of features.
+        
+    Features are sent back as `Detections`, which pickle down to a single small
+    array instead of a list of dicts, once for every frame received. If no frame
+    arrives (see `MotionGate`), nothing is sent back.
         
     See `ImageProvider` for more information.
     '''
+    registry = CascadeRegistry().preload(list(target_features) + list(preload))
+    cascades = [(name, registry.get(name)) for name in target_features]
+    
     while True:
-        output = None
         try:
             # bookkeeping
             message = message_queue.get(False)
             if message == "terminate":
                 return
+            if message[0] == "target":
+                cascades = [(name, registry.get(name)) for name in message[1]]
         except Queue.Empty:
             pass
         
         try:
-            # Get the image, but give up if it takes longer then 2 seconds to get.
+            # Get the image, but give up if it takes longer then 2 seconds to get,
+            # so that messages are still checked for.
             raw = images_queue.get(timeout = 2)
-            
-            # Convert the raw image string into a SimpleCV image object.
-            bmp = scv.cv.CreateImageHeader(size, scv.cv.IPL_DEPTH_8U, 3)
-            scv.cv.SetData(bmp, raw)
-            scv.cv.CvtColor(bmp, bmp, scv.cv.CV_RGB2BGR)
-            img = scv.Image(bmp)
-            
-            # Use Haar features as usual.
-            features = img.scale(quality).findHaarFeatures(target_feature + '.xml')
-            if features is not None:
-                output = []
-                scale = round(1 / quality)
-                for feature in features:
-                    x, y = feature.topLeftCorner()
-                    output.append({
-                        'height': feature.height() * scale,
-                        'width': feature.width() * scale,
-                        'top_left_x': x * scale,
-                        'top_right_x': y * scale,
-                        'center_x': feature.x * scale,
-                        'center_y': feature.y * scale,
-                        #'full_feature': feature
-                    })
-            # If any of the Queues to receive data is empty or full, ignore.
         except Queue.Empty:
-            pass
-        except Queue.Full:
-            pass
-        features_queue.put(output)
+            continue
+            
+        # Use Haar features as usual.
+        features_queue.put(_find_features_in_gray(raw, size, cascades, scale))
         
           
           
@@ -253,17 +1042,53 @@ class ImageProvider(object):
     This class provides a friendly way to process features in a separate process
     and return results.
     '''
-    def __init__(self, cam, delta=1):
+    def __init__(self, cam, delta=1, quality=0.5, gate=None):
+        '''
+        Arguments:
+        
+        -   cam:  
+            The camera to grab images from.
+        -   delta:  
+            How many seconds to keep returning the last features found
+            if the worker stops sending results (for example, if it 
+            isn't getting any frames).
+        -   quality:  
+            The quality to analyze images at. See `get_human_locations`.
+        -   gate:
+            A `MotionGate`, which skips frames that haven't changed while 
+            the robot isn't moving. If None, every frame is analyzed.
+        '''
         self.cam = cam
-        self.features = []
-        self.last = time.time()
+        self.features = Detections()
+        self.sequence = 0
         self.delta = delta
+        self.quality = quality
+        self.gate = gate
+        
+        # How many frames were sent to the worker, how many it sent 
+        # results back for, how many were skipped by the gate, and how 
+        # many times the worker stopped answering.
+        self.processed = 0
+        self.analyzed = 0
+        self.skipped = 0
+        self.timeouts = 0
         
-    def start(self, feature):
+        # True while the worker is busy with a frame we sent it.
+        self.waiting = False
+        
+    def start(self, features, preload=()):
         '''
         This method starts a separate process to find features. It also 
         provides an initial image for the process to work with.
         
+        `features` can either be the name of a single feature, or a list 
+        of them. If there is more than one, all of them are searched for 
+        in every frame and the results are merged together.
+        
+        The cascades for every feature in `preload` are loaded along with 
+        the ones in `features`, so that `set_target` can switch to them 
+        without any delay.
+        
         Note: the only way to communicate between two processes (the original
         program is technically a process) is through Queues, which are thread-safe
         list-like objects where you can append and take data.
@@ -276,37 +1101,82 @@ class ImageProvider(object):
         '''
         img = self.cam.getImage()#.flipHorizontal()
         self.size = img.size()
+        raw, gray_size = preprocess(img, self.quality)
 
         self.features_queue = multiprocessing.Queue()
         
         self.images_queue = multiprocessing.Queue()
-        self.images_queue.put(img.toString())
+        self.images_queue.put(raw)
+        self.waiting = True
+        self.sent = time.time()
+        if self.gate is not None:
+            self.gate.changed(img, force=True)
         
         self.message_queue = multiprocessing.Queue()
         
+        features = self._validate(features)
+        self._validate(preload)
+        
         self.worker = multiprocessing.Process(target=_get_features, args=(
-            self.features_queue, self.images_queue, self.message_queue, self.size, 0.5, feature))
+            self.features_queue, self.images_queue, self.message_queue, gray_size, 
+            (self.size[0] / gray_size[0], self.size[1] / gray_size[1]), 
+            features, tuple(preload)))
         self.worker.start()
         
-    def get_features(self):
-        '''This grabs an image from the camera, converts it to a string, and 
-        passes it to the worker to process. While the worker returns None
-        (not finished processing), this method will return the last known
-        list of features. Otherwise, it'll return the newest one and command
-        the worker to start processing a new frame.'''
-        img = self.cam.getImage()#.flipHorizontal()
+    def _validate(self, features):
+        if isinstance(features, basestring):
+            features = [features]
+        for name in features:
+            if name not in VALID_FEATURES:
+                raise ValueError('{0} is not a valid feature'.format(name))
+        return list(features)
         
-        try:
-            features = self.features_queue.get(False)
-            self.images_queue.put(img.toString())
-            if features is not None:
-                self.last = time.time()
-                self.features = features
-            elif (time.time() - self.last) > self.delta:
-                self.features = []
-        except Queue.Empty:
-            pass
+    def set_target(self, features):
+        '''Switches the worker to looking for a different feature (or list
+        of features).'''
+        self.message_queue.put(('target', self._validate(features)))
+        
+    def get_features(self, image=None, moving=True):
+        '''When the worker is ready for a new frame, this shrinks `image` 
+        (or, if it's None, a new image from the camera) and converts it to
+        a grayscale string (see `preprocess`), and passes it to the worker to 
+        process. While the worker is still busy, this method will return the 
+        last known list of features. Otherwise, it'll return the newest one 
+        (even if it's empty) and command the worker to start processing a 
+        new frame.
         
+        If there's a `gate` and `moving` is False (the robot is standing 
+        still), frames that look the same as the last one analyzed aren't
+        sent to the worker, and the last features found are returned 
+        instead.
+        
+        The features are returned as `Detections`. `sequence` goes up by one
+        every time they change. The raw results are noisy, so they should 
+        usually be passed through a `Tracker`, which smooths them out.'''
+        if self.waiting:
+            try:
+                features = self.features_queue.get(False)
+            except Queue.Empty:
+                if (time.time() - self.sent) > self.delta and len(self.features) > 0:
+                    # The worker has stopped answering.
+                    self.features = Detections()
+                    self.sequence += 1
+                    self.timeouts += 1
+                return self.features
+            self.waiting = False
+            self.features = features
+            self.sequence += 1
+            self.analyzed += 1
+            
+        if image is None:
+            image = self.cam.getImage()#.flipHorizontal()
+        if self.gate is not None and not self.gate.changed(image, force=moving):
+            self.skipped += 1
+            return self.features
+        self.images_queue.put(preprocess(image, self.quality)[0])
+        self.waiting = True
+        self.sent = time.time()
+        self.processed += 1
         return self.features
         
     def end(self):
@@ -317,16 +1187,119 @@ class ImageProvider(object):
 def get_centroid(features):
     '''Calculates a sequence of features, and finds the average x and y centerpoints
     between them. Therefore, given a crowd of people, this function can find the 
-    approximate center of the crowd.'''
-    center_x = []
-    center_y = []
-    for feature in features:
-        center_x.append(feature['center_x'])
-        center_y.append(feature['center_y'])
-    average = lambda x: int(round(sum(x) / len(x)))
-    if len(center_x) == 0 or len(center_y) == 0:
-        return (0, 0)
-    return (average(center_x), average(center_y))
+    approximate center of the crowd.
+    
+    `features` can either be `Detections` or a list of dicts.'''
+    return as_detections(features).centroid()
+    
+    
+class Odometry(object):
+    '''
+    Works out where the robot is and how fast it's going from how far each
+    wheel has turned (see `basic_hardware.Encoders`).
     
+    Every time new encoder counts arrive, the distance each wheel moved 
+    since the last reading is used to move the robot along an arc, 
+    assuming it was turning at a steady rate in between. This drifts a 
+    little over time (wheels slip), but it's quick and accurate over 
+    short distances.
+    
+    The position is stored as `x` and `y` (in meters from where the robot
+    started) and `heading` (in radians, counter-clockwise). `velocity` is
+    in meters per second, and `angular_velocity` is in radians per second.
+    '''
+    def __init__(self, ticks_per_meter, wheel_base, smoothing=0.5):
+        '''
+        Arguments:
         
+        -   ticks_per_meter:
+            How many encoder ticks a wheel makes while rolling a meter.
+        -   wheel_base:
+            The distance between the two wheels in meters.
+        -   smoothing:
+            How much of the previous speed to keep when working out the 
+            new one, from 0 (none) to 1 (all of it). 
+        '''
+        self.ticks_per_meter = ticks_per_meter
+        self.wheel_base = wheel_base
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        with self.lock:
+            self.x = 0.0
+            self.y = 0.0
+            self.heading = 0.0
+            self.velocity = 0.0
+            self.angular_velocity = 0.0
+            self.wheel_speeds = {"left": 0.0, "right": 0.0}
+            self.last = None
         
+    def update(self, left, right, timestamp):
+        '''Takes new encoder counts for each wheel, read at `timestamp` 
+        seconds.'''
+        with self.lock:
+            if self.last is None:
+                self.last = (left, right, timestamp)
+                return
+            last_left, last_right, last_time = self.last
+            dt = timestamp - last_time
+            if dt <= 0:
+                return
+            self.last = (left, right, timestamp)
+            
+            left_distance = (left - last_left) / self.ticks_per_meter
+            right_distance = (right - last_right) / self.ticks_per_meter
+            distance = (left_distance + right_distance) / 2
+            turn = (right_distance - left_distance) / self.wheel_base
+            
+            # Move along the heading halfway through the turn.
+            middle = self.heading + turn / 2
+            self.x += distance * math.cos(middle)
+            self.y += distance * math.sin(middle)
+            self.heading += turn
+            
+            for side, moved in (("left", left_distance), ("right", right_distance)):
+                self.wheel_speeds[side] = (self.smoothing * self.wheel_speeds[side] + 
+                    (1 - self.smoothing) * moved / dt)
+            self.velocity = (self.wheel_speeds["left"] + self.wheel_speeds["right"]) / 2
+            self.angular_velocity = (self.wheel_speeds["right"] - self.wheel_speeds["left"]) / self.wheel_base
+            
+    def pose(self):
+        '''Returns (x, y, heading).'''
+        with self.lock:
+            return (self.x, self.y, self.heading)
+            
+    def wheel_speed(self, side):
+        '''Returns how fast a wheel is turning in meters per second. This
+        can be passed to `robot_actions.calibrate_motors`.'''
+        with self.lock:
+            return self.wheel_speeds[side]
+
+
+def nearest_obstacle(readings, max_range=4.0):
+    '''
+    Returns how far away (in meters) the closest obstacle is, or None if 
+    nothing is within `max_range`.
+    
+    `readings` is a dict mapping each rangefinder to a list of the 
+    distances it recently measured, as returned by 
+    `basic_hardware.Rangefinders.read`. Ultrasonic sensors now and then 
+    hear a stray echo (or miss one), so each sensor's distance is the 
+    median of its recent readings, which ignores the odd bad one. A 
+    reading of None (nothing echoed back) counts as being very far away.
+    
+    Silent sensors (None instead of a list) are skipped, since we can't 
+    tell what's in front of them. That's not the same as the way being 
+    clear, so check `basic_hardware.Rangefinders.silent` (or 
+    `Robot.sonar_blind`) too.
+    '''
+    nearest = None
+    for distances in readings.values():
+        if not distances:
+            continue
+        distance = np.median([np.inf if d is None else d for d in distances])
+        if distance <= max_range and (nearest is None or distance < nearest):
+            nearest = float(distance)
+    return nearest
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+'''
+# simulator.py #
+
+
+## About ##
+
+This module lets us run the robot without an actual robot.
+
+`basic_hardware.FakeArduino` is good enough to stop the program from
+crashing when no Arduino is plugged in, but it has no idea about time,
+so it can't tell us how fast (or slow) the code would run on a real
+robot. This module goes further and pretends to be the actual serial
+cable plugged into the Arduino:
+
+-   `FakeSerial` behaves like a `serial.Serial` object. It understands
+    the same commands the Arduino sketch does (the `@cmd%arg%arg$!`
+    strings built by `arduino_modified.build_cmd_str`), answers them the
+    same way, and takes just as long to do it -- every byte takes
+    `10 / baud` seconds to send, and every command takes an extra
+    `latency` seconds to get to the board and back.
+-   `SimulatedRobot` watches the motor pins and works out where the
+    robot would have driven to, using [differential drive][dd]
+    kinematics.
+-   If asked to (see `Arduino.streamEncoders`), `FakeSerial` also pushes
+    the simulated robot's encoder counts every few milliseconds, just 
+    like a sketch that supports streaming would.
+    The same goes for any pins subscribed to with `Arduino.subscribe`.
+
+  [dd]: http://planning.cs.uiuc.edu/node659.html
+
+Since `FakeSerial` looks like a serial port, we can hand it to the real
+`arduino_modified.Arduino` class, which means the rest of the code is
+exactly the same code that runs on the robot.
+
+`FakeSerial` also counts every byte and command sent, which makes it
+handy for measuring how much we're stressing the serial link.
+
+
+## Running headless ##
+
+`run` drives the whole decision-making stack (the state machine, the
+robot, and the serial link) as fast as it can without a camera or a
+display, and reports how many ticks per second it managed and how much
+serial traffic that caused. To run it from the command line:
+
+    python simulator.py [seconds]
+
+
+## Dependencies ##
+
+*   This module uses the `basic_hardware` layer to find out which pins
+    the motors are plugged into.
+*   `run` uses the `sensor_analysis`, `robot_actions` and 
+    `decision_making` layers to drive the simulated robot.
+'''
+
+from __future__ import division
+
+import bisect
+import math
+import struct
+import sys
+import threading
+import time
+
+import basic_hardware
+import robot_actions
+import sensor_analysis
+import decision_making
+import arduino_modified as Arduino
+
+
+class SimulatedRobot(object):
+    '''
+    Models a two-wheeled robot driven by the motor pins described in
+    `basic_hardware.Motor.PINS`.
+
+    The position is stored as `x` and `y` (in meters) and `heading` (in
+    radians, counter-clockwise, where 0 is along the x axis).
+    
+    `obstacles` is a list of (x, y) points that the rangefinders can see.
+    Every rangefinder points straight ahead.
+    '''
+    
+    # How wide (in radians, either side of straight ahead) a rangefinder
+    # can see, and how far.
+    SONAR_ANGLE = math.radians(15)
+    SONAR_RANGE = 4.0
+    
+    def __init__(self, max_wheel_speed=0.5, wheel_base=0.4, motor_gains=None, deadband=0):
+        '''
+        Arguments:
+
+        -   max_wheel_speed:
+            How fast a wheel moves (in meters per second) at full power.
+        -   wheel_base:
+            The distance between the two wheels in meters.
+        -   motor_gains:
+            A dict mapping "left" and "right" to a multiplier for each
+            motor, to simulate mismatched motors. By default, the motors 
+            are as mismatched as `basic_hardware.DEFAULT_GAINS` says ours
+            are.
+        -   deadband:
+            The fraction of full power below which the motors don't move
+            at all.
+        '''
+        self.max_wheel_speed = max_wheel_speed
+        self.wheel_base = wheel_base
+        self.motor_gains = motor_gains or dict(basic_hardware.DEFAULT_GAINS)
+        self.deadband = deadband
+
+        self.pins = {}
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.distance = {"left": 0.0, "right": 0.0}
+        self.obstacles = []
+        self.last_update = time.time()
+
+    def wheel_speed(self, side):
+        '''Returns the current speed of a wheel in meters per second.'''
+        pins = basic_hardware.Motor.PINS[side]
+        dir_A = self.pins.get(pins["dir"][0], "LOW")
+        dir_B = self.pins.get(pins["dir"][1], "LOW")
+        if dir_A == "HIGH" and dir_B == "LOW":
+            direction = 1
+        elif dir_A == "LOW" and dir_B == "HIGH":
+            direction = -1
+        else:
+            return 0.0
+        power = self.pins.get(pins["PWM"], 0) / 255
+        if power <= self.deadband:
+            return 0.0
+        return direction * power * self.motor_gains[side] * self.max_wheel_speed
+
+    def update(self, now=None):
+        '''Moves the robot forward in time up to `now`.'''
+        if now is None:
+            now = time.time()
+        dt = now - self.last_update
+        if dt <= 0:
+            return
+        self.last_update = now
+
+        left = self.wheel_speed("left")
+        right = self.wheel_speed("right")
+        self.distance["left"] += left * dt
+        self.distance["right"] += right * dt
+
+        speed = (left + right) / 2
+        turn = (right - left) / self.wheel_base
+        if abs(turn) < 1e-9:
+            self.x += speed * dt * math.cos(self.heading)
+            self.y += speed * dt * math.sin(self.heading)
+        else:
+            # Drive along an arc.
+            radius = speed / turn
+            new_heading = self.heading + turn * dt
+            self.x += radius * (math.sin(new_heading) - math.sin(self.heading))
+            self.y -= radius * (math.cos(new_heading) - math.cos(self.heading))
+            self.heading = new_heading
+
+    def encoder_count(self, side):
+        '''Returns how many ticks the encoder on a wheel has counted.'''
+        return int(self.distance[side] * basic_hardware.Encoders.TICKS_PER_METER)
+        
+    def ping(self):
+        '''Returns how long (in microseconds) a rangefinder's echo takes to
+        come back, or 0 if nothing is in range.'''
+        nearest = None
+        for (x, y) in self.obstacles:
+            dx, dy = x - self.x, y - self.y
+            distance = math.hypot(dx, dy)
+            angle = math.atan2(dy, dx) - self.heading
+            angle = math.atan2(math.sin(angle), math.cos(angle))
+            if distance <= self.SONAR_RANGE and abs(angle) <= self.SONAR_ANGLE:
+                nearest = distance if nearest is None else min(nearest, distance)
+        if nearest is None:
+            return 0
+        return int(nearest / basic_hardware.Rangefinders.METERS_PER_MICROSECOND)
+        
+    def set_pin(self, pin, value, now=None):
+        # Everything up until now happened with the old pin values.
+        self.update(now)
+        self.pins[pin] = value
+
+
+class FakeSerial(object):
+    '''
+    Pretends to be a `serial.Serial` object connected to an Arduino
+    running the Python Arduino Command API sketch.
+
+    If `realtime` is False, nothing actually sleeps, but the time it
+    would have taken is still added up in `busy_time`.
+    '''
+    def __init__(self, robot=None, baud=9600, latency=0.004, timeout=2, realtime=True):
+        self.robot = robot if robot is not None else SimulatedRobot()
+        self.baudrate = baud
+        self.latency = latency
+        self.timeout = timeout
+        self.realtime = realtime
+
+        self.is_open = True
+        self.pin_modes = {}
+        self.servos = {}
+        self.responses = []
+        self.buffer = ''
+        self.streams = {}
+        self.started = time.time()
+        self.watchdog = None
+        self.last_command = None
+        self.watchdog_trips = 0
+
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.bytes_streamed = 0
+        self.commands = {}
+        self.busy_time = 0.0
+        self.busy_until = time.time()
+        self.lock = threading.Lock()
+
+    def transmit_time(self, num_bytes):
+        '''How long it takes to send `num_bytes` bytes (8N1: 10 bits a byte).'''
+        return num_bytes * 10 / self.baudrate
+
+    def _wait(self, duration):
+        '''Holds the line for `duration` seconds after whatever is already
+        being sent, and returns the time it finishes.'''
+        now = time.time()
+        self.busy_until = max(self.busy_until, now) + duration
+        self.busy_time += duration
+        return self.busy_until
+
+    def _sleep_until(self, when):
+        if self.realtime:
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        with self.lock:
+            self.bytes_written += len(data)
+            arrival = self._wait(self.transmit_time(len(data))) + self.latency
+            self.buffer += data
+            while '$!' in self.buffer:
+                command, self.buffer = self.buffer.split('$!', 1)
+                if '@' in command:
+                    self.execute(command[command.index('@') + 1:], arrival)
+        return len(data)
+
+    def flush(self):
+        self._sleep_until(self.busy_until)
+
+    def inWaiting(self):
+        now = time.time()
+        with self.lock:
+            self._stream(now)
+            return sum(len(data) for (ready, data) in self.responses if ready <= now or not self.realtime)
+            
+    def read(self, size=1):
+        '''Returns up to `size` bytes, waiting a little if there's nothing
+        to read yet.'''
+        now = time.time()
+        output = ''
+        with self.lock:
+            self._stream(now)
+            while self.responses and len(output) < size:
+                ready, data = self.responses[0]
+                if ready > now and self.realtime:
+                    break
+                self.responses.pop(0)
+                output += data
+        if output == '':
+            time.sleep(0.005)
+        self.bytes_read += len(output)
+        return output
+        
+    def _check_watchdog(self, now):
+        '''Stops the motors if the watchdog (see `Arduino.setWatchdog`) ran
+        out before `now`.'''
+        if self.watchdog is None or self.last_command is None:
+            return
+        expired = self.last_command + self.watchdog
+        if expired > now:
+            return
+        for pins in basic_hardware.Motor.PINS.values():
+            if self.robot.pins.get(pins["PWM"], 0) != 0:
+                self.robot.set_pin(pins["PWM"], 0, expired)
+                self.watchdog_trips += 1
+        # Only stop once until we hear from the host again.
+        self.last_command = None
+        
+    def _stream(self, now):
+        '''Pushes every frame that should have been sent by `now`.'''
+        self._check_watchdog(now)
+        for key, (interval, due, kind, payload) in self.streams.items():
+            while due <= now:
+                self.robot.update(due)
+                frame = Arduino.build_frame(kind, payload(due))
+                self.bytes_streamed += len(frame)
+                bisect.insort(self.responses, (due + self.transmit_time(len(frame)), frame))
+                due += interval
+            self.streams[key] = (interval, due, kind, payload)
+            
+    def _millis(self, now):
+        return int((now - self.started) * 1000) & 0xFFFFFFFF
+        
+    def _encoder_payload(self, now):
+        return struct.pack(basic_hardware.Encoders.FORMAT, self._millis(now),
+            self.robot.encoder_count("left"),
+            self.robot.encoder_count("right"))
+            
+    def _sample(self, mode, pin):
+        '''Reads a pin the way `sub` would.'''
+        if mode == Arduino.SUBSCRIBE_MODES['digital']:
+            return 1 if self.robot.pins.get(pin) == 'HIGH' else 0
+        if mode == Arduino.SUBSCRIBE_MODES['pulse']:
+            return self.robot.ping()
+        value = self.robot.pins.get(pin, 0)
+        return value if isinstance(value, int) else 0
+        
+    def _samples_payload(self, mode, pins):
+        def payload(now):
+            return struct.pack('<I', self._millis(now)) + ''.join(
+                struct.pack('<BBH', mode, pin, self._sample(mode, pin)) 
+                for pin in pins)
+        return payload
+
+    def readline(self):
+        with self.lock:
+            if len(self.responses) == 0:
+                if self.realtime:
+                    time.sleep(self.timeout)
+                return ''
+            ready, data = self.responses.pop(0)
+        self._sleep_until(ready)
+        self.bytes_read += len(data)
+        return data
+
+    def respond(self, data, arrival):
+        data = str(data) + '\r\n'
+        ready = arrival + self.transmit_time(len(data))
+        bisect.insort(self.responses, (ready, data))
+
+    def execute(self, command, now):
+        '''Carries out a single command, as the Arduino sketch would.'''
+        parts = command.split('%')
+        name = parts[0]
+        # The sketch uses `String.toInt()`, which ignores anything after a
+        # decimal point.
+        args = [int(float(arg)) for arg in parts[1:] if arg]
+        self.commands[name] = self.commands.get(name, 0) + 1
+        self._check_watchdog(now)
+        self.last_command = now
+
+        if name == 'version':
+            self.respond('version', now)
+        elif name == 'pm':
+            self.pin_modes[abs(args[0])] = 'INPUT' if args[0] < 0 else 'OUTPUT'
+        elif name == 'dw':
+            self.robot.set_pin(abs(args[0]), 'LOW' if args[0] < 0 else 'HIGH', now)
+        elif name == 'aw':
+            self.robot.set_pin(args[0], max(0, min(255, args[1])), now)
+        elif name == 'ar':
+            self.respond(self.robot.pins.get(args[0], 0), now)
+        elif name == 'dr':
+            self.respond(1 if self.robot.pins.get(args[0]) == 'HIGH' else 0, now)
+        elif name in ('pi', 'ps'):
+            self.robot.update(now)
+            self.respond(self.robot.ping(), now)
+        elif name == 'sva':
+            self.servos[args[0]] = 0
+            self.respond(len(self.servos) - 1, now)
+        elif name == 'svw':
+            self.servos[args[0]] = args[1]
+        elif name == 'svr':
+            self.respond(self.servos.get(args[0], 0), now)
+        elif name == 'wd':
+            self.watchdog = args[0] / 1000 if args[0] > 0 else None
+        elif name == 'es':
+            # Encoder pins, then the interval in milliseconds.
+            self.streams['E'] = (args[2] / 1000, now, 'E', self._encoder_payload)
+        elif name == 'sub':
+            # The interval in milliseconds, the mode, then the pins.
+            interval, mode, pins = args[0], args[1], tuple(args[2:])
+            for key in self.streams.keys():
+                if key[0] == 'S' and key[1] == mode:
+                    self._drop_pins(key, pins)
+            self.streams[('S', mode, pins)] = (
+                interval / 1000, now, 'S', self._samples_payload(mode, pins))
+        elif name == 'usub':
+            for key in self.streams.keys():
+                if key[0] == 'S' and key[1] == args[0]:
+                    self._drop_pins(key, args[1:])
+                    
+    def _drop_pins(self, key, pins):
+        '''Stops streaming `pins` as part of the subscription `key`.'''
+        interval, due, kind, payload = self.streams.pop(key)
+        remaining = tuple(pin for pin in key[2] if pin not in pins)
+        if remaining:
+            self.streams[('S', key[1], remaining)] = (
+                interval, due, kind, self._samples_payload(key[1], remaining))
+
+    def stats(self):
+        '''Returns a dict describing how much the serial link was used.'''
+        total = sum(self.commands.values())
+        return {
+            'bytes_written': self.bytes_written,
+            'bytes_read': self.bytes_read,
+            'bytes_streamed': self.bytes_streamed,
+            'commands': total,
+            'commands_by_name': dict(self.commands),
+            'bytes_per_command': self.bytes_written / total if total else 0,
+            'busy_time': self.busy_time,
+            'board_watchdog_trips': self.watchdog_trips,
+        }
+
+
+def make_arduino(baud=9600, latency=0.004, realtime=True, robot=None):
+    '''
+    Returns a real `arduino_modified.Arduino` object talking to a
+    simulated robot. The `FakeSerial` object can be found with 
+    `fake_serial`.
+    '''
+    serial = FakeSerial(robot, baud=baud, latency=latency, realtime=realtime)
+    return Arduino.Arduino(baud, sr=serial)
+
+
+def fake_serial(arduino):
+    '''Returns the `FakeSerial` object behind an Arduino made by 
+    `make_arduino`.'''
+    serial = arduino.sr
+    # Once anything is streaming, the serial object is wrapped in an
+    # `arduino_modified.StreamDemux`.
+    if isinstance(serial, Arduino.StreamDemux):
+        serial = serial.sr
+    return serial
+    
+def measure_wheel_speed(arduino):
+    '''
+    Returns a function that tells how fast each wheel of the simulated 
+    robot behind `arduino` is turning, for `robot_actions.calibrate_motors`.
+    '''
+    return lambda side: fake_serial(arduino).robot.wheel_speed(side)
+    
+
+def run(duration=10, baud=9600, latency=0.004, realtime=True, humans=None, 
+        obstacles=None):
+    '''
+    Runs the state machine against a simulated robot for `duration`
+    seconds with no camera or display, and returns a dict of statistics.
+
+    `humans` is a function that takes the elapsed time and returns the
+    list of detected humans to feed the state machine. By default, a
+    single person wanders back and forth in front of the robot.
+    
+    `obstacles` is a list of (x, y) points (in meters) for the robot's 
+    rangefinder to spot; the robot starts at (0, 0) facing along the x 
+    axis.
+    '''
+    if humans is None:
+        def humans(elapsed):
+            x = 320 + 250 * math.sin(elapsed)
+            return [{'height': 100, 'width': 100, 'top_left_x': x - 50,
+                'top_right_x': 190, 'center_x': x, 'center_y': 240, 
+                'feature': 'upper_body'}]
+
+    arduino = make_arduino(baud, latency, realtime)
+    fake_serial(arduino).robot.obstacles = list(obstacles or [])
+    robot = robot_actions.Robot(arduino, encoders=True, sonar=[7])
+    watchdog = robot_actions.Watchdog(robot)
+    states = decision_making.startup(robot)
+    states.start()
+
+    # Skip the startup screen, since nobody's going to press the button.
+    states.state.press('Continue')
+
+    tracker = sensor_analysis.Tracker()
+    calibration = sensor_analysis.CameraCalibration()
+    data = {'image_size': (640, 480), 'straight': 0, 'rotate': 0, 'manual': False}
+    ticks = 0
+    start = time.time()
+    while time.time() - start < duration:
+        data['humans'] = calibration.measure(tracker.update(humans(time.time() - start)), 640)
+        target = tracker.lock()
+        data['target'] = dict(target.items()) if target is not None else None
+        data['obstacle'] = robot.obstacle_distance()
+        data['sonar_blind'] = robot.sonar_blind()
+        states.loop(data)
+        robot.update()
+        watchdog.heartbeat()
+        ticks += 1
+    elapsed = time.time() - start
+    watchdog.close()
+    robot.stop()
+    arduino.close()
+
+    serial = fake_serial(arduino)
+    simulated = serial.robot
+    output = serial.stats()
+    output.update({
+        'ticks': ticks,
+        'ticks_per_second': ticks / elapsed,
+        'elapsed': elapsed,
+        'pose': (simulated.x, simulated.y, simulated.heading),
+        'odometry': robot.odometry.pose(),
+        'final_state': states.state_name,
+        'watchdog_trips': watchdog.trips,
+    })
+    return output
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, value in sorted(run(seconds).items()):
+        print '{0}: {1}'.format(name, value)
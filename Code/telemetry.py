@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+'''
+# telemetry.py #
+
+
+## About ##
+
+This module records what the robot was doing on every single tick of the
+state machine so that we can figure out what went wrong after the fact
+(a "post-mortem").
+
+For every tick, we record:
+
+-   The time
+-   The name of the current state
+-   The `straight` and `rotate` values sent from the dashboard
+-   The speed of the left and right motors
+-   The centroid of the detected humans
+-   The location of every detected human
+
+The text log (`log.txt`) is only written when something explodes, and the
+dashboard only polls twice a second, so neither of them can tell us what
+happened in the half-second before the robot drove into a table.
+
+
+## The file format ##
+
+The recorder can be called hundreds of times a second, so it can't
+afford to format text or hit the disk on every tick. Instead, it saves
+ticks into memory and writes them out in "blocks" of a few hundred ticks
+at a time from a separate thread.
+
+Within a block, the data is stored column by column (all the timestamps,
+then all the state names, then all the `straight` values, etc) instead
+of tick by tick. This is called a [columnar format][col], and is both
+more compact and much faster to read and write, since each column is
+just a raw array of numbers.
+
+  [col]: https://en.wikipedia.org/wiki/Column-oriented_DBMS
+
+The file is append-only. It starts with a small header, and is followed
+by a series of blocks. Every block looks like this:
+
+    tag (1 byte) | payload length (4 bytes) | payload | block length (4 bytes)
+
+There are three kinds of blocks:
+
+-   `N` (name) blocks, which assign a number to a state name the first
+    time we see it. Data blocks store the number instead of the name.
+-   `D` (data) blocks, which contain the recorded ticks.
+-   `I` (index) blocks, which are written every few data blocks. Each
+    one contains the position and time range of the data blocks written
+    since the previous index block, the position of the previous index
+    block, and every state name seen so far.
+
+The block length at the end of every block lets us read the file
+backwards. To find a time range, the reader starts at the end of the
+file and hops from index block to index block, so it only needs to
+touch a handful of places in the file no matter how big it is. If the
+program crashed and the end of the file is garbled, the reader falls
+back to scanning the block headers from the start.
+
+All numbers are stored little-endian.
+
+
+## Startup timing ##
+
+This module also contains `PhaseTimer`, which measures how long each
+part of starting up the robot takes, so we can tell what to blame when
+the robot takes forever to get going.
+
+
+## Dependencies ##
+
+None -- this module only uses the Python standard library.
+'''
+
+from __future__ import division
+
+import array
+import bisect
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
+
+MAGIC = 'NBTLM\x00'
+VERSION = 1
+
+_FILE_HEADER = struct.Struct('<6sH')
+_BLOCK_HEADER = struct.Struct('<cI')
+_BLOCK_TRAILER = struct.Struct('<I')
+_DATA_HEADER = struct.Struct('<Idd')
+_NAME_HEADER = struct.Struct('<H')
+_INDEX_HEADER = struct.Struct('<qIH')
+_INDEX_ENTRY = struct.Struct('<qddI')
+_INDEX_NAME = struct.Struct('<HB')
+
+# The columns stored in every data block, in order, along with the
+# `array` typecode used to store them.
+COLUMNS = [
+    ('time', 'd'),
+    ('state', 'H'),
+    ('straight', 'f'),
+    ('rotate', 'f'),
+    ('left_speed', 'f'),
+    ('right_speed', 'f'),
+    ('centroid_x', 'h'),
+    ('centroid_y', 'h'),
+    ('human_count', 'H'),
+]
+
+# Every detected human is stored as four numbers in a final, variable
+# length column.
+HUMAN_FIELDS = ['top_left_x', 'top_right_x', 'width', 'height']
+
+
+class PhaseTimer(object):
+    '''
+    Measures how long each "phase" of a process takes. Call `mark` at the
+    end of each phase, and `report` to get a summary.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.phases = []
+
+    def mark(self, name):
+        '''Ends the current phase, and calls it `name`.'''
+        now = time.time()
+        self.phases.append((name, now - self.last, False))
+        self.last = now
+
+    def record(self, name, seconds):
+        '''Records a phase which ran in the background, at the same time
+        as the other phases.'''
+        self.phases.append((name, seconds, True))
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        lines = ['Started up in {0:.2f} sec:'.format(self.total())]
+        for name, seconds, background in self.phases:
+            lines.append('    {0:<28} {1:6.2f} sec{2}'.format(
+                name, seconds, ' (in the background)' if background else ''))
+        return '\n'.join(lines)
+
+
+class TelemetryError(Exception):
+    '''Raised when a telemetry file is unreadable.'''
+    pass
+
+
+def _to_bytes(column):
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tostring()
+
+def _from_bytes(typecode, raw):
+    column = array.array(typecode)
+    column.fromstring(raw)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+def _clamp_short(value):
+    return max(-32768, min(32767, int(value)))
+
+
+class Recorder(object):
+    '''
+    Records every tick of the state machine into a telemetry file.
+
+    Calling `record` only appends numbers to a few in-memory arrays.
+    Full blocks are handed off to a background thread, which does the
+    actual packing and writing.
+    '''
+    def __init__(self, path, block_size=256, index_every=16):
+        '''
+        Arguments:
+
+        -   path:
+            The file to write to. It will be overwritten if it exists.
+        -   block_size:
+            The number of ticks to store in each data block.
+        -   index_every:
+            How many data blocks to write before writing an index block.
+        '''
+        self.path = path
+        self.block_size = block_size
+        self.index_every = index_every
+        self.names = {}
+        self.ticks = 0
+        self.blocks = 0
+        self.is_recording = True
+
+        self._columns = self._new_columns()
+        self._humans = array.array('h')
+        self._queue = Queue.Queue()
+
+        self._file = open(path, 'wb')
+        self._file.write(_FILE_HEADER.pack(MAGIC, VERSION))
+        self._index = []
+        self._last_index = -1
+
+        self._writer = threading.Thread(target=self._write_loop, name='telemetry')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _new_columns(self):
+        return [array.array(code) for (name, code) in COLUMNS]
+
+    def record(self, state_name, straight, rotate, left_speed, right_speed,
+            humans, centroid, timestamp=None):
+        '''
+        Records a single tick. `humans` is the list of features returned
+        by `sensor_analysis`, and `centroid` is an (x, y) tuple.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+
+        state = self.names.get(state_name)
+        if state is None:
+            state = len(self.names)
+            self.names[state_name] = state
+            self._queue.put(('N', (state, state_name)))
+
+        (times, states, straights, rotates, lefts, rights,
+            centroid_xs, centroid_ys, counts) = self._columns
+        times.append(timestamp)
+        states.append(state)
+        straights.append(straight or 0)
+        rotates.append(rotate or 0)
+        lefts.append(left_speed)
+        rights.append(right_speed)
+        centroid_xs.append(_clamp_short(centroid[0]))
+        centroid_ys.append(_clamp_short(centroid[1]))
+        counts.append(len(humans))
+        for human in humans:
+            self._humans.extend([_clamp_short(human[field]) for field in HUMAN_FIELDS])
+
+        self.ticks += 1
+        if len(times) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        '''Hands the ticks recorded so far to the writer thread.'''
+        if len(self._columns[0]) == 0:
+            return
+        self._queue.put(('D', (self._columns, self._humans)))
+        self._columns = self._new_columns()
+        self._humans = array.array('h')
+
+    def close(self):
+        '''Writes out everything left over and closes the file.'''
+        if not self.is_recording:
+            return
+        self.flush()
+        self._queue.put(('close', None))
+        self._writer.join()
+        self.is_recording = False
+
+    def _write_loop(self):
+        while True:
+            kind, payload = self._queue.get()
+            if kind == 'N':
+                state, name = payload
+                self._write_block('N', _NAME_HEADER.pack(state) + name.encode('utf-8'))
+            elif kind == 'D':
+                self._write_data(*payload)
+                if len(self._index) >= self.index_every:
+                    self._write_index()
+            elif kind == 'close':
+                if len(self._index) > 0:
+                    self._write_index()
+                self._file.close()
+                return
+
+    def _write_block(self, tag, payload):
+        offset = self._file.tell()
+        self._file.write(_BLOCK_HEADER.pack(tag, len(payload)))
+        self._file.write(payload)
+        self._file.write(_BLOCK_TRAILER.pack(
+            _BLOCK_HEADER.size + len(payload) + _BLOCK_TRAILER.size))
+        return offset
+
+    def _write_data(self, columns, humans):
+        times = columns[0]
+        parts = [_DATA_HEADER.pack(len(times), times[0], times[-1])]
+        parts.extend(_to_bytes(column) for column in columns)
+        parts.append(_to_bytes(humans))
+        offset = self._write_block('D', ''.join(parts))
+        self._index.append((offset, times[0], times[-1], len(times)))
+        self.blocks += 1
+
+    def _write_index(self):
+        parts = [_INDEX_HEADER.pack(self._last_index, len(self._index), len(self.names))]
+        parts.extend(_INDEX_ENTRY.pack(*entry) for entry in self._index)
+        for name, state in sorted(self.names.items(), key=lambda pair: pair[1]):
+            encoded = name.encode('utf-8')[:255]
+            parts.append(_INDEX_NAME.pack(state, len(encoded)) + encoded)
+        self._last_index = self._write_block('I', ''.join(parts))
+        self._index = []
+        self._file.flush()
+
+
+class TelemetryReader(object):
+    '''
+    Reads a telemetry file written by `Recorder`.
+
+    Opening the file only loads the index. The ticks themselves are only
+    read when you ask for a time range using `read`.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        header = self.file.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            raise TelemetryError('{0} is not a telemetry file'.format(path))
+        magic, version = _FILE_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise TelemetryError('{0} is not a telemetry file'.format(path))
+
+        self.names = {}
+        self.blocks = []
+        try:
+            self._load_backwards()
+        except TelemetryError:
+            self.names = {}
+            self.blocks = []
+            self._load_forwards()
+        self.blocks.sort()
+        self._starts = [block[0] for block in self.blocks]
+
+    def close(self):
+        self.file.close()
+
+    def _read_at(self, offset, size):
+        self.file.seek(offset)
+        raw = self.file.read(size)
+        if len(raw) < size:
+            raise TelemetryError('Unexpected end of file at {0}'.format(offset))
+        return raw
+
+    def _read_block(self, offset):
+        '''Returns the tag and payload length of the block at `offset`.'''
+        tag, length = _BLOCK_HEADER.unpack(self._read_at(offset, _BLOCK_HEADER.size))
+        if tag not in 'NDI' or offset + _BLOCK_HEADER.size + length + _BLOCK_TRAILER.size > self.size:
+            raise TelemetryError('Bad block at {0}'.format(offset))
+        return tag, length
+
+    def _add_block(self, tag, offset, length):
+        payload = offset + _BLOCK_HEADER.size
+        if tag == 'D':
+            count, start, end = _DATA_HEADER.unpack(self._read_at(payload, _DATA_HEADER.size))
+            self.blocks.append((start, end, offset, count))
+        elif tag == 'N':
+            raw = self._read_at(payload, length)
+            (state,) = _NAME_HEADER.unpack(raw[:_NAME_HEADER.size])
+            self.names.setdefault(state, raw[_NAME_HEADER.size:].decode('utf-8'))
+
+    def _read_index(self, offset, length):
+        raw = self._read_at(offset + _BLOCK_HEADER.size, length)
+        previous, num_entries, num_names = _INDEX_HEADER.unpack_from(raw)
+        position = _INDEX_HEADER.size
+        for i in range(num_entries):
+            block, start, end, count = _INDEX_ENTRY.unpack_from(raw, position)
+            self.blocks.append((start, end, block, count))
+            position += _INDEX_ENTRY.size
+        for i in range(num_names):
+            state, name_length = _INDEX_NAME.unpack_from(raw, position)
+            position += _INDEX_NAME.size
+            self.names.setdefault(state, raw[position:position + name_length].decode('utf-8'))
+            position += name_length
+        return previous
+
+    def _load_backwards(self):
+        '''Hops backwards from the end of the file using the index blocks.'''
+        end = self.size
+        while end > _FILE_HEADER.size:
+            (length,) = _BLOCK_TRAILER.unpack(self._read_at(end - _BLOCK_TRAILER.size, _BLOCK_TRAILER.size))
+            offset = end - length
+            if offset < _FILE_HEADER.size:
+                raise TelemetryError('Bad block trailer at {0}'.format(end))
+            tag, payload_length = self._read_block(offset)
+            if _BLOCK_HEADER.size + payload_length + _BLOCK_TRAILER.size != length:
+                raise TelemetryError('Bad block trailer at {0}'.format(end))
+            if tag == 'I':
+                previous = self._read_index(offset, payload_length)
+                while previous >= 0:
+                    tag, payload_length = self._read_block(previous)
+                    if tag != 'I':
+                        raise TelemetryError('Bad index pointer at {0}'.format(offset))
+                    previous = self._read_index(previous, payload_length)
+                return
+            self._add_block(tag, offset, payload_length)
+            end = offset
+
+    def _load_forwards(self):
+        '''Scans every block header from the start, stopping at the first
+        incomplete block.'''
+        offset = _FILE_HEADER.size
+        while offset < self.size:
+            try:
+                tag, length = self._read_block(offset)
+                if tag == 'I':
+                    self._read_index(offset, length)
+                else:
+                    self._add_block(tag, offset, length)
+            except (TelemetryError, struct.error):
+                break
+            offset += _BLOCK_HEADER.size + length + _BLOCK_TRAILER.size
+        # Index blocks repeat the data blocks we've already seen.
+        self.blocks = list(set(self.blocks))
+
+    def time_range(self):
+        '''Returns the time of the first and last recorded tick.'''
+        if len(self.blocks) == 0:
+            return (None, None)
+        return (self.blocks[0][0], max(block[1] for block in self.blocks))
+
+    def read(self, start=None, end=None):
+        '''
+        Returns every tick recorded between `start` and `end` (inclusive)
+        as a dict mapping the column names in `COLUMNS` to lists. The
+        `state` column contains the state names, and there is an extra
+        `humans` column containing a list of dicts for every tick.
+        '''
+        if start is None:
+            start = float('-inf')
+        if end is None:
+            end = float('inf')
+
+        output = {name: [] for (name, code) in COLUMNS}
+        output['humans'] = []
+
+        # Blocks are sorted by start time, so we can skip every block
+        # starting after `end`.
+        last = bisect.bisect_right(self._starts, end)
+        for (block_start, block_end, offset, count) in self.blocks[:last]:
+            if block_end < start:
+                continue
+            self._read_data(offset, start, end, output)
+        return output
+
+    def _read_data(self, offset, start, end, output):
+        tag, length = self._read_block(offset)
+        raw = self._read_at(offset + _BLOCK_HEADER.size, length)
+        count = _DATA_HEADER.unpack_from(raw)[0]
+        position = _DATA_HEADER.size
+
+        columns = []
+        for (name, code) in COLUMNS:
+            size = array.array(code).itemsize * count
+            columns.append(_from_bytes(code, raw[position:position + size]))
+            position += size
+        humans = _from_bytes('h', raw[position:])
+
+        times = columns[0]
+        counts = columns[-1]
+        human_position = 0
+        for i in range(count):
+            num_fields = counts[i] * len(HUMAN_FIELDS)
+            if start <= times[i] <= end:
+                for (name, code), column in zip(COLUMNS, columns):
+                    output[name].append(column[i])
+                output['state'][-1] = self.names.get(columns[1][i], '')
+                output['humans'].append([
+                    dict(zip(HUMAN_FIELDS, humans[j:j + len(HUMAN_FIELDS)]))
+                    for j in range(human_position, human_position + num_fields, len(HUMAN_FIELDS))])
+            human_position += num_fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -22,6 +22,12 @@ to power the state machine.
 Technically, we could have used SimpleCV's display window. However, I 
 chose to use pygame for the additional flexibility it gave us.
 
+The robot can also run "headless", without any screen at all. In that case,
+nothing is drawn, pygame is never even imported, and the buttons that would
+normally be on screen are pressed from the dashboard instead. Because of 
+this, pygame and the `drawing` module are only imported by `load_display`
+once we know we need them.
+
 ## Dependencies ##
 
 This layer requires every module within this project, the SimpleCV
@@ -36,25 +42,58 @@ After reading this file, move to `dashboard.py`
 # Libraries included within the Python standard library
 import sys
 import json
-import copy
+import cPickle
 import types
+import threading
 import multiprocessing
 
 import basic_hardware
+import cameras
 import sensor_analysis
 import robot_actions
 import decision_making
-import drawing
 import dashboard
+import simulator
+import telemetry
 
 import arduino_modified as Arduino
 import SimpleCV as scv
-import cv2
-import pygame
 
 DEBUG = False
 
+# How many frames a second to send to the dashboard.
+DASHBOARD_FPS = 15
+
+# Things that can't be sent to the dashboard (which gets everything 
+# through a `multiprocessing.Manager`, and so has to be able to pickle it),
+# and so are never inspected: locks (like the one each 
+# `basic_hardware.Motor` has), threads (like the one reading the serial 
+# port), and methods (like the listeners of `basic_hardware.Encoders`).
+UNINSPECTABLE = (
+    type(threading.Lock()), 
+    type(threading.RLock()), 
+    threading.Thread, 
+    types.MethodType)
+
+# These are imported by `load_display`.
+pygame = None
+drawing = None
+
+def load_display():
+    '''Imports the modules needed to draw to the screen.'''
+    global pygame, drawing
+    import pygame
+    import drawing
+
 
+def _copy(value):
+    '''Copies `value` by pickling it, the same way it'd be sent to the 
+    dashboard. Anything that can't be pickled is hidden.'''
+    try:
+        return cPickle.loads(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return "(HIDDEN)"
+        
 def inspect(thing, layers=1, prettyprint = False, exclude=[]):
     '''
     This function performs a bit of meta-programming to inspect 
@@ -88,23 +127,27 @@ def inspect(thing, layers=1, prettyprint = False, exclude=[]):
     out useless values (such as non-primitive objects), and inspecting 
     nested objects if `layers` is greater then `.
     '''
-    if type(thing) == dict:
-        return thing
-        
-    try:
-        output = copy.deepcopy(thing.__dict__)
-    except AttributeError:
-        return thing
+    hidden = tuple(exclude) + UNINSPECTABLE
+    if isinstance(thing, dict):
+        items = thing.items()
+    elif hasattr(thing, '__dict__'):
+        items = thing.__dict__.items()
+    else:
+        return _copy(thing)
         
-    if layers > 1:
-        for attr, value in thing.__dict__.items():
-            if not isinstance(value, exclude):
-                output[attr] = inspect(value, layers - 1, prettyprint, exclude=exclude)
-    
-    output = {attr: "(HIDDEN)" if isinstance(value, exclude) else value for (attr, value) in output.items()}
+    output = {}
+    for attr, value in items:
+        # Keys can be anything in a dict, but must be strings in JSON.
+        attr = str(attr)
+        if isinstance(value, hidden):
+            output[attr] = "(HIDDEN)"
+        elif layers > 1:
+            output[attr] = inspect(value, layers - 1, False, exclude=exclude)
+        else:
+            output[attr] = _copy(value)
     
     if prettyprint:
-        return json.dumps(output, indent=4)
+        return json.dumps(output, indent=4, default=repr)
     else:
         # This is a very clumsy way of filtering out objects that don't
         # have a sensible string representation.
@@ -118,50 +161,93 @@ class ControlPanel(object):
     '''
     This class is the main UI.
     '''
-    def __init__(self, robot, state):
+    def __init__(self, robot, state, recorder=None, camera=None, headless=False, timer=None,
+            calibration=None, token=None):
+        '''
+        If `recorder` is a `telemetry.Recorder`, every tick of the state
+        machine is recorded to it.
+        
+        If `camera` is None, the webcam is used. Otherwise, it should be
+        one of the cameras from `cameras.py`.
+        
+        If `headless` is True, nothing is drawn to the screen.
+        
+        `timer` is the `telemetry.PhaseTimer` used to measure how long it
+        takes to start up.
+        
+        `calibration` is the `sensor_analysis.CameraCalibration` used to 
+        work out how far away people are. If it's None, the defaults are 
+        used.
+        
+        `token` is the password for the dashboard. If it's None, a random
+        one is made up and printed.
+        '''
         self.robot = robot
         self.state = state
+        self.recorder = recorder
+        self.cam = camera
+        self.headless = headless
+        self.timer = timer if timer is not None else telemetry.PhaseTimer()
+        self.calibration = calibration if calibration is not None else sensor_analysis.CameraCalibration()
+        self.token = token
         
     def setup(self):
-        pygame.init()
-        self.window = drawing.Window()
-        self.screen = self.window.screen
-        self.font = pygame.font.SysFont("arial", 12)
+        if not self.headless:
+            load_display()
+            pygame.init()
+            self.window = drawing.Window()
+            self.screen = self.window.screen
+            self.font = pygame.font.SysFont("arial", 12)
+            self.timer.mark('opening the window')
 
-        self.to_inspect = [
-            ('robot', self.robot, 2, (
-                Arduino.Arduino, 
-                basic_hardware.FakeArduino, 
-                scv.Camera)), 
-            ('state', self.state, 3, (
-                Arduino.Arduino, 
-                basic_hardware.FakeArduino, 
-                scv.Camera, 
-                robot_actions.Robot))
-        ]
+        self.to_inspect = inspected_objects(self.robot, self.state)
                 
         self.state.start()
 
-        self.cam = scv.Camera(1)
-        self.images = sensor_analysis.ImageProvider(self.cam)
+        # Every camera is shared through `cameras.SERVICE`, and each part 
+        # of the program that needs frames gets them at its own rate.
+        if self.cam is None:
+            self.cam = cameras.SERVICE.open(1)
+            self.timer.mark('opening the camera')
+        else:
+            self.cam = cameras.SERVICE.add(1, self.cam)
+        self.dashboard_frames = cameras.SERVICE.subscribe(1, rate=DASHBOARD_FPS)
+        self.debug_frames = cameras.SERVICE.subscribe(1)
+        self.images = sensor_analysis.ImageProvider(
+            cameras.SERVICE.subscribe(1), 
+            gate=sensor_analysis.MotionGate())
+        self.tracker = sensor_analysis.Tracker()
         self.is_manual = False
             
-        # Currently detects the face. See the source code of 
-        # `sensor_analysis.find_human_features` for a full list of possible
+        # Currently detects faces (from the front and from the side) and 
+        # upper bodies, since faces get lost when people turn around and 
+        # upper bodies get lost when people are up close. See 
+        # `sensor_analysis.VALID_FEATURES` for a full list of possible 
         # features.
-        #self.images.start('upper_body')
-        self.images.start('face')
+        self.images.start(['face', 'profile', 'upper_body'])
+        self.timer.mark('starting image processing')
         
         self.mailbox = multiprocessing.Queue()
         self.image_queue = multiprocessing.Queue(maxsize=1)
         self.data = multiprocessing.Manager().dict()
+        # (count, straight, rotate) from the dashboard's joystick; see 
+        # `dashboard.py`.
+        self.joystick = multiprocessing.Array('d', 3)
+        self.joystick_count = 0
         self.dashboard = dashboard.Dashboard(
                 'dashboard', 
                 self.data, 
                 self.mailbox, 
                 self.image_queue, 
-                self.images.size)
+                self.images.size,
+                self.joystick,
+                self.token)
         self.dashboard.start()
+        self.timer.mark('starting the dashboard')
+        print 'Dashboard (replace localhost with this computer\'s address): ' + self.dashboard.url()
+        
+        # Stops the robot if this loop (or the dashboard) goes quiet.
+        self.watchdog = robot_actions.Watchdog(self.robot)
 
         
         
@@ -178,18 +264,25 @@ class ControlPanel(object):
         self.data['rotate'] = 0
         self.data['manual'] = False
         self.data['mousepress'] = None
+        self.data['button'] = None
+        self.data['buttons'] = []
         self.data['image_size'] = self.images.size
         
+        first_tick = True
+        image = None
         try:    
             while True:
                 # I/O: From computer
-                mousepress = self.process_events()
+                if self.headless:
+                    mousepress = None
+                else:
+                    mousepress = self.process_events()
                 
-                image = self.cam.getImage()
-                image = image.flipHorizontal()
-
-                if self.image_queue.empty():
-                    self.image_queue.put(image.toString())
+                # The camera is read in the background, so none of this 
+                # waits for a frame.
+                frame = self.dashboard_frames.poll()
+                if frame is not None and self.image_queue.empty():
+                    self.image_queue.put(frame[0].flipHorizontal().toString())
                 
                 #self.try_manual_control()
                 
@@ -197,13 +290,41 @@ class ControlPanel(object):
                 while not self.mailbox.empty():
                     name, value = self.mailbox.get_nowait()
                     self.data[name] = value
+                    if name in ('straight', 'rotate'):
+                        self.watchdog.command()
+                        
+                # The joystick skips the mailbox, so the newest position
+                # is used as soon as it arrives.
+                with self.joystick.get_lock():
+                    count, straight, rotate = self.joystick[:]
+                if count != self.joystick_count:
+                    self.joystick_count = count
+                    self.data['straight'] = straight
+                    self.data['rotate'] = rotate
+                    self.watchdog.command()
+                        
+                # If the browser stopped sending the joystick position 
+                # (say it disconnected), stop driving.
+                if ((self.data['straight'] or self.data['rotate']) and 
+                        not self.watchdog.commands_fresh()):
+                    self.data['straight'] = 0
+                    self.data['rotate'] = 0
                 
                 # Processing
-                features = self.images.get_features()
+                # While the robot is standing still, frames that haven't 
+                # changed aren't analyzed again.
+                features = self.tracker.update(
+                    self.images.get_features(moving=self.robot.is_moving()), 
+                    self.images.sequence)
+                self.calibration.measure(features, self.images.size[0])
+                target = self.tracker.lock()
 
                 # Update state
                 self.data['centroid'] = sensor_analysis.get_centroid(features)
                 self.data['humans'] = features
+                self.data['target'] = dict(target.items()) if target is not None else None
+                self.data['obstacle'] = self.robot.obstacle_distance()
+                self.data['sonar_blind'] = self.robot.sonar_blind()
                 self.data['mousepress'] = mousepress
                 
                 for name, obj in self.get_inspected():
@@ -211,10 +332,25 @@ class ControlPanel(object):
                 
                 # Handling decisions
                 self.state.loop(self.data)
-                if not DEBUG:
+                self.robot.update()
+                self.watchdog.heartbeat()
+                if self.recorder is not None:
+                    self.record(features)
+                    
+                # Buttons can only be pressed once
+                self.data['button'] = None
+                self.data['buttons'] = self.state.state.buttons
+                
+                if self.headless:
+                    pass
+                elif not DEBUG:
                     self.state.draw(self.data, self.window)
                 else:
-                    self.debug(image, features)
+                    frame = self.debug_frames.poll()
+                    if frame is not None:
+                        image = frame[0].flipHorizontal()
+                    if image is not None:
+                        self.debug(image, features)
 
                 # Display
                 #self.draw_camera_feed(image)
@@ -223,13 +359,33 @@ class ControlPanel(object):
                 
                 # Bookkeeping
                 #self.heartbeat()
+                if first_tick:
+                    self.timer.mark('first tick')
+                    print self.timer.report()
+                    first_tick = False
         except:
             raise
         finally:
-            pygame.quit()
+            if not self.headless:
+                pygame.quit()
             self.images.end()
             self.dashboard.terminate()
-            self.robot.zero_speed()
+            self.watchdog.close()
+            self.robot.stop()
+            if self.recorder is not None:
+                self.recorder.close()
+            cameras.SERVICE.close()
+
+    def record(self, features):
+        '''Saves everything that happened during this tick to the recorder.'''
+        self.recorder.record(
+            self.state.state_name,
+            self.data.get('straight', 0),
+            self.data.get('rotate', 0),
+            self.robot.left_wheel.speed,
+            self.robot.right_wheel.speed,
+            features,
+            self.data['centroid'])
     
     def debug(self, image, features):
         self.draw_camera_feed(image.flipHorizontal())
@@ -328,16 +484,90 @@ class ControlPanel(object):
         pygame.display.flip()
         self.screen.fill((0,0,0))
             
-def main():
-    robot = robot_actions.Robot()
+def main(record=None, replay=None, record_frames=None, realtime=True, simulate=False,
+        headless=False, arduino=None, timer=None, calibration=None, motors=None,
+        encoders=False, sonar=None, token=None):
+    '''
+    Starts the robot. 
+    
+    If `record` is a filename, every tick of the state machine is recorded
+    to that file (see `telemetry.py`). 
+    
+    If `replay` is a directory, camera frames are played back from there
+    instead of coming from the webcam (at the speed they were recorded at
+    if `realtime` is True, or as fast as possible otherwise). If 
+    `record_frames` is a directory, every camera frame is recorded there.
+    See `cameras.py` for details.
+    
+    If `simulate` is True, the robot is driven through a simulated serial 
+    link instead of a real Arduino (see `simulator.py`).
+    
+    If `headless` is True, nothing is drawn to the screen, and the robot
+    is controlled only through the camera and the dashboard.
+    
+    If `arduino` is None, the Arduino is found automatically. `timer` is 
+    a `telemetry.PhaseTimer` which measures how long starting up takes.
+    
+    If `calibration` is a filename, the camera calibration is loaded from 
+    there (see `sensor_analysis.CameraCalibration`). If `motors` is a 
+    filename, the motor profiles are loaded from there (see 
+    `basic_hardware.MotorProfile`). If `encoders` is True (or the robot is
+    simulated), the wheel encoders are used to keep track of where the 
+    robot is. `sonar` is a list of the pins ultrasonic rangefinders are 
+    plugged into, which are used to avoid bumping into things (see
+    `decision_making.AvoidObstacleState`).
+    
+    `token` is the password needed to use the dashboard (see 
+    `dashboard.py`). If it's None, a random one is made up.
+    '''
+    if timer is None:
+        timer = telemetry.PhaseTimer()
+    profiles = None
+    if motors is not None:
+        profiles = basic_hardware.load_profiles(motors)
+    if simulate:
+        robot = robot_actions.Robot(simulator.make_arduino(), profiles=profiles, encoders=True,
+            sonar=sonar)
+    else:
+        robot = robot_actions.Robot(arduino, profiles=profiles, encoders=encoders, sonar=sonar)
     states = decision_making.startup(robot)
-    control = ControlPanel(robot, states)
+    recorder = None
+    if record is not None:
+        recorder = telemetry.Recorder(record)
+    timer.mark('setting up the robot')
+    camera = cameras.SERVICE.open(1, replay, record_frames, realtime)
+    timer.mark('opening the camera')
+    if calibration is not None:
+        calibration = sensor_analysis.CameraCalibration.load(calibration)
+    control = ControlPanel(robot, states, recorder, camera, headless, timer, calibration, token)
     control.mainloop()
     
+def inspected_objects(robot, state):
+    '''Returns what the dashboard shows, as a list of (name, object, depth,
+    types to hide) for `inspect`.'''
+    return [
+        ('robot', robot, 2, (
+            Arduino.Arduino, 
+            basic_hardware.FakeArduino, 
+            scv.Camera)), 
+        ('state', state, 3, (
+            Arduino.Arduino, 
+            basic_hardware.FakeArduino, 
+            scv.Camera, 
+            robot_actions.Robot))
+    ]
+    
 def test_inspector():
-    robot = robot_actions.Robot(Arduino())
+    '''Checks that everything the dashboard is sent can be pickled.'''
+    arduino = simulator.make_arduino()
+    robot = robot_actions.Robot(arduino, encoders=True, sonar=[7])
+    states = decision_making.startup(robot)
     robot.set_forward_speed(1)
-    print inspect(robot, 2, True)
+    data = multiprocessing.Manager().dict()
+    for (name, obj, depth, exclude) in inspected_objects(robot, states):
+        data[name] = inspect(obj, depth, exclude=exclude)
+        print inspect(obj, depth, True, exclude=exclude)
+    arduino.close()
     
     
     